@@ -0,0 +1,744 @@
+#! /usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General License for more details.
+#
+# You should have received a copy of the GNU General License
+# along with self program.  If not, see <http://www.gnu.org/licenses/>
+#
+
+# Benchmark of detection.detect over a generated corpus.
+#
+# Every carrier format is generated at every size, clean and with each
+# payload appended, from a seeded PRNG so that the corpus is the same on
+# every run. Reports throughput, latency percentiles and peak RSS per format
+# and per detector, and checks each verdict against where the payload was
+# actually put.
+#
+#   python benchmark.py [-sizes:16k,1m,16m] [-formats:jpeg,flac,...]
+#       [-payloads:clean,rar,...] [-repeat:N] [-corpus:DIR]
+#       [-save:FILE] [-compare:FILE]
+#
+# Sizes take k, m and g suffixes. -corpus:DIR keeps the corpus there for
+# later runs. -save: stores the verdicts and -compare: exits with an error
+# if any verdict differs from the stored ones.
+
+from __future__ import absolute_import
+
+import collections
+import io
+import json
+import math
+import multiprocessing
+import os
+import random
+import shutil
+import struct
+import sys
+import tempfile
+import zipfile
+import zlib
+
+from PIL import Image
+from PIL import ImageFile
+
+from detection import detect
+from detection import utils
+from detection.by_ending.parsers import FLAC_CRC16, crc8, ogg_crc
+from detection.metrics import call_traced
+
+SEED = 1
+SIZES = '16k,1m,16m'
+REPEAT = 3
+# Pixel formats grow by pixel count; tiers beyond this are skipped
+MAX_PIXELS = 1 << 26
+# Unit of generated noise and of most repeated structures
+BLOCK = 1 << 16
+
+
+def noise(rnd, n):
+    if n <= 0:
+        return ''
+    return ('%0*x' % (2 * n, rnd.getrandbits(8 * n))).decode('hex')
+
+
+def noise_blocks(rnd, n):
+    while n > 0:
+        yield noise(rnd, min(n, BLOCK))
+        n -= BLOCK
+
+
+def parse_size(s):
+    units = {'k': 1 << 10, 'm': 1 << 20, 'g': 1 << 30}
+    s = s.strip().lower()
+    if s[-1:] in units:
+        return int(float(s[:-1]) * units[s[-1]])
+    return int(s)
+
+
+def sizeof_fmt(num):
+    for unit in ['', 'k', 'm']:
+        if num < 1024:
+            return '%d%s' % (num, unit)
+        num //= 1024
+    return '%dg' % num
+
+
+# Carriers. Each takes a random.Random and a target size and yields the
+# file in chunks; the size is only approximate.
+
+def encode(image, fmt, **params):
+    # detection.by_ending.pillow sets ImageFile.MAXBLOCK to 1, with which
+    # the encoders write one byte at a time
+    maxblock, ImageFile.MAXBLOCK = ImageFile.MAXBLOCK, 1 << 16
+    try:
+        b = io.BytesIO()
+        image.save(b, fmt, **params)
+        return b.getvalue()
+    finally:
+        ImageFile.MAXBLOCK = maxblock
+
+
+def noise_image(rnd, size, bytes_per_pixel, mode='RGB'):
+    side = max(int(math.sqrt(size / bytes_per_pixel)), 16)
+    if side * side > MAX_PIXELS:
+        return
+    channels = len(mode) if mode != 'P' else 1
+    image = Image.frombytes(mode, (side, side),
+                            noise(rnd, side * side * channels))
+    if mode == 'P':
+        image.putpalette(map(ord, noise(rnd, 768)))
+    return image
+
+
+def gen_jpeg(rnd, size):
+    image = noise_image(rnd, size, 0.9)
+    if image:
+        yield encode(image, 'JPEG', quality=90)
+
+
+def gen_png(rnd, size):
+    image = noise_image(rnd, size, 3)
+    if image:
+        yield encode(image, 'PNG', compress_level=1)
+
+
+def gen_gif(rnd, size):
+    image = noise_image(rnd, size, 1.1, 'P')
+    if image:
+        yield encode(image, 'GIF')
+
+
+def gen_tiff(rnd, size):
+    image = noise_image(rnd, size, 3)
+    if image:
+        yield encode(image, 'TIFF')
+
+
+def ebml(nodeid, data, size=None):
+    # Elements given only a `size` are written in 8 bytes, so that masters
+    # can be sized before their contents are generated. libmagic needs the
+    # short form at least for the DocType.
+    if size is None:
+        size = len(data)
+        width = 1
+        while size >= (1 << 7 * width) - 1:
+            width += 1
+    else:
+        width = 8
+    return (struct.pack('>L', nodeid).lstrip('\x00') +
+            struct.pack('>Q', size | 1 << 7 * width)[8 - width:] + data)
+
+
+def ebml_uint(nodeid, value):
+    return ebml(nodeid, struct.pack('>Q', value).lstrip('\x00') or '\x00')
+
+
+def gen_webm(rnd, size):
+    yield ebml(0x1A45DFA3, ''.join([
+        ebml_uint(0x4286, 1),  # EBMLVersion
+        ebml_uint(0x42F7, 1),  # EBMLReadVersion
+        ebml_uint(0x42F2, 4),  # EBMLMaxIDLength
+        ebml_uint(0x42F3, 8),  # EBMLMaxSizeLength
+        ebml(0x4282, 'webm'),  # DocType
+        ebml_uint(0x4287, 2),  # DocTypeVersion
+        ebml_uint(0x4285, 2),  # DocTypeReadVersion
+    ]))
+
+    info = ebml(0x1549A966, ebml_uint(0x2AD7B1, 1000000))
+    tracks = ebml(0x1654AE6B, ebml(0xAE, ''.join([
+        ebml_uint(0xD7, 1),  # TrackNumber
+        ebml_uint(0x73C5, 1),  # TrackUID
+        ebml_uint(0x83, 1),  # TrackType: video
+        ebml(0x86, 'V_VP8'),  # CodecID
+        ebml(0xE0, ebml_uint(0xB0, 640) + ebml_uint(0xBA, 480)),
+    ])))
+
+    # Clusters of 16 frames of BLOCK bytes each
+    frame = BLOCK - 4
+    nclusters = max(size // (16 * BLOCK), 1)
+    blocks = 16 if size >= 16 * BLOCK else max(size // BLOCK, 1)
+    block_size = len(ebml(0xA3, '', frame + 4)) + frame + 4
+    # Cluster Timecode in a fixed 4 bytes
+    cluster_size = len(ebml(0xE7, '\x00' * 4)) + blocks * block_size
+    segment_size = (len(info) + len(tracks) + nclusters *
+                    (len(ebml(0x1F43B675, '', 0)) + cluster_size))
+
+    yield ebml(0x18538067, '', segment_size) + info + tracks
+    for i in range(nclusters):
+        yield (ebml(0x1F43B675, '', cluster_size) +
+               ebml(0xE7, struct.pack('>L', i * 1000)))
+        for j in range(blocks):
+            # SimpleBlock: track 1, relative timecode, keyframe flag
+            yield (ebml(0xA3, '', frame + 4) +
+                   struct.pack('>BhB', 0x81, j * 40, 0x80) +
+                   noise(rnd, frame))
+
+
+def gen_ogg(rnd, size):
+    serial = rnd.getrandbits(32)
+
+    def page(seq, granule, packets, flags=0):
+        lacing = []
+        for packet in packets:
+            lacing += [255] * (len(packet) // 255) + [len(packet) % 255]
+        header = struct.pack('<4sBBqIIIB', 'OggS', 0, flags, granule,
+                             serial, seq, 0, len(lacing))
+        data = header + ''.join(map(chr, lacing)) + ''.join(packets)
+        return data[:22] + struct.pack('<I', ogg_crc(data)) + data[26:]
+
+    # Vorbis identification header, so that libmagic calls it audio
+    yield page(0, 0, [struct.pack('<B6sIBIiiiBB', 1, 'vorbis', 0, 2, 44100,
+                                  0, 128000, 0, 0xB8, 1)], flags=2)
+
+    # Packets of 254 * 255 bytes fill a page's 255 lacing values exactly
+    packet = 254 * 255
+    npages = max(size // packet, 1)
+    for seq in range(1, npages + 1):
+        yield page(seq, seq * 1024, [noise(rnd, packet)],
+                   flags=4 if seq == npages else 0)
+
+
+def flac_utf8(n):
+    if n < 0x80:
+        return chr(n)
+    for length in range(2, 8):
+        if n < 1 << (5 * length + 1):
+            break
+    tail = []
+    for i in range(length - 1):
+        tail.append(chr(0x80 | n & 0x3F))
+        n >>= 6
+    lead = (0xFF << (8 - length)) & 0xFF | n
+    return chr(lead) + ''.join(reversed(tail))
+
+
+def crc16(data, value=0):
+    for r in bytearray(data):
+        value = ((value << 8) & 0xFFFF) ^ FLAC_CRC16[(value >> 8) ^ r]
+    return value
+
+
+def gen_flac(rnd, size):
+    # Mono 16 bit, 4096 samples per frame, verbatim subframes
+    blocksize = 4096
+    bodies = ['\x02' + noise(rnd, blocksize * 2) for i in range(8)]
+    length = len(bodies[0])
+
+    # The CRC-16 is linear: that of header + body is that of the header
+    # run over the body's length of zeros, xor that of the body. Running
+    # over the zeros is itself linear, kept as its image of each bit.
+    zeros = [crc16('\x00' * length, 1 << bit) for bit in range(16)]
+    body_crcs = [crc16(body) for body in bodies]
+
+    def crc_over_zeros(value):
+        ret = 0
+        for bit in range(16):
+            if value >> bit & 1:
+                ret ^= zeros[bit]
+        return ret
+
+    nframes = max(size // length, 1)
+    headers = []
+    for n in range(nframes):
+        header = ('\xff\xf8' + chr(0xC9) + chr(0x08) + flac_utf8(n))
+        headers.append(header + chr(crc8(header)))
+    sizes = [len(h) + length + 2 for h in headers]
+
+    streaminfo = (struct.pack('>HH', blocksize, blocksize) +
+                  struct.pack('>L', min(sizes))[1:] +
+                  struct.pack('>L', max(sizes))[1:] +
+                  struct.pack('>Q', 44100 << 44 | 0 << 41 | 15 << 36 |
+                              blocksize * nframes) +
+                  '\x00' * 16)
+    yield ('fLaC' + chr(0x80) + struct.pack('>L', len(streaminfo))[1:] +
+           streaminfo)
+
+    for header in headers:
+        i = rnd.randrange(len(bodies))
+        crc = crc_over_zeros(crc16(header)) ^ body_crcs[i]
+        yield header + bodies[i] + struct.pack('>H', crc)
+
+
+def gen_wav(rnd, size, riff_size=None):
+    # Mono 16 bit PCM
+    data = size // 2 * 2
+    if riff_size is None:
+        riff_size = 36 + data
+    yield ('RIFF' + struct.pack('<L', riff_size) + 'WAVE' +
+           'fmt ' + struct.pack('<LHHLLHH', 16, 1, 1, 44100, 88200, 2, 16) +
+           'data' + struct.pack('<L', data))
+    for block in noise_blocks(rnd, data):
+        yield block
+
+
+def gen_wav_streamed(rnd, size):
+    # Without the RIFF size, which streaming writers cannot know
+    return gen_wav(rnd, size, 0)
+
+
+def gen_pdf(rnd, size):
+    out = ['%PDF-1.4\n%\xe2\xe3\xcf\xd3\n']
+    pos = [len(out[0])]
+    offsets = []
+
+    def obj(data):
+        offsets.append(pos[0])
+        data = '%d 0 obj\n%s\nendobj\n' % (len(offsets), data)
+        pos[0] += len(data)
+        return data
+
+    nstreams = max(size // BLOCK, 1)
+    yield out[0]
+    yield obj('<< /Type /Catalog /Pages 2 0 R >>')
+    yield obj('<< /Type /Pages /Kids [] /Count 0 >>')
+    for i in range(nstreams):
+        yield obj('<< /Length %d >>\nstream\n%s\nendstream'
+                  % (BLOCK, noise(rnd, BLOCK)))
+
+    xref = pos[0]
+    yield ('xref\n0 %d\n0000000000 65535 f \n' % (len(offsets) + 1) +
+           ''.join('%010d 00000 n \n' % offset for offset in offsets) +
+           'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n'
+           % (len(offsets) + 1, xref))
+
+
+def gen_svg(rnd, size):
+    yield ('<?xml version="1.0" encoding="UTF-8"?>\n'
+           '<svg xmlns="http://www.w3.org/2000/svg" '
+           'width="1000" height="1000">\n')
+    written = 0
+    while written < size:
+        lines = ''.join(
+            '<rect x="%d" y="%d" width="%d" height="%d" fill="#%06x"/>\n'
+            % (rnd.randrange(1000), rnd.randrange(1000), rnd.randrange(100),
+               rnd.randrange(100), rnd.getrandbits(24))
+            for i in range(1000))
+        written += len(lines)
+        yield lines
+    yield '</svg>\n'
+
+
+def gen_xcf(rnd, size):
+    # One RGB layer, uncompressed 64x64 tiles
+    tile = 64 * 64 * 3
+    ntiles = max(size // tile, 1)
+    side = 64 * int(math.ceil(math.sqrt(ntiles)))
+    ntiles = (side // 64) ** 2
+
+    def string(s):
+        return struct.pack('>L', len(s) + 1) + s + '\x00'
+
+    # PROP_COMPRESSION none, PROP_END
+    props = struct.pack('>LLB', 17, 1, 0) + struct.pack('>LL', 0, 0)
+    header = ('gimp xcf file\x00' + struct.pack('>LLL', side, side, 0) +
+              props)
+    # Layer: size, type, name, PROP_END, then hierarchy and mask pointers
+    layer = (struct.pack('>LLL', side, side, 0) + string('Background') +
+             struct.pack('>LL', 0, 0))
+
+    # Layer pointers and channel pointers, each list ended by a 0
+    p_layer = len(header) + 12
+    p_hierarchy = p_layer + len(layer) + 8
+    p_level = p_hierarchy + 20
+    p_tiles = p_level + 8 + 4 * (ntiles + 1)
+
+    yield header + struct.pack('>LLL', p_layer, 0, 0)
+    yield layer + struct.pack('>LL', p_hierarchy, 0)
+    yield struct.pack('>LLLLL', side, side, 3, p_level, 0)
+    yield (struct.pack('>LL', side, side) +
+           ''.join(struct.pack('>L', p_tiles + i * tile)
+                   for i in range(ntiles)) + struct.pack('>L', 0))
+    for i in range(ntiles):
+        yield noise(rnd, tile)
+
+
+def gen_djvu(rnd, size):
+    chunks = []
+    info = struct.pack('>HHBB', 1000, 1000, 24, 0) + struct.pack('<H', 300)
+    chunks.append('INFO' + struct.pack('>L', len(info)) + info + '\x00\x00')
+    n = max(size // BLOCK, 1)
+    form = 4 + sum(map(len, chunks)) + n * (8 + BLOCK)
+    yield 'AT&TFORM' + struct.pack('>L', form) + 'DJVU' + ''.join(chunks)
+    for i in range(n):
+        yield 'BG44' + struct.pack('>L', BLOCK) + noise(rnd, BLOCK)
+
+
+def gen_midi(rnd, size):
+    ntracks = max(size // BLOCK, 1)
+    yield 'MThd' + struct.pack('>LHHH', 6, 1, ntracks, 480)
+    for i in range(ntracks):
+        events = []
+        length = 0
+        while length < BLOCK - 16:
+            note = rnd.randrange(128)
+            event = ('\x60' + chr(0x90) + chr(note) + chr(rnd.randrange(128)) +
+                     '\x60' + chr(0x80) + chr(note) + '\x00')
+            events.append(event)
+            length += len(event)
+        events.append('\x00\xff\x2f\x00')  # End of Track
+        track = ''.join(events)
+        yield 'MTrk' + struct.pack('>L', len(track)) + track
+
+
+def gen_pe(rnd, size):
+    # PE32 with a single section, headers padded to FileAlignment
+    raw = max(size // 0x200, 1) * 0x200
+    dos = 'MZ' + '\x00' * 0x3A + struct.pack('<L', 0x80)
+    dos += 'This program cannot be run in DOS mode.'.ljust(0x40, '\x00')
+    coff = struct.pack('<4sHHLLLHH', 'PE\x00\x00', 0x14C, 1, 0, 0, 0, 0xE0,
+                       0x0102)
+    optional = struct.pack(
+        '<HBBLLLLLLLLLHHHHHHLLLLHHLLLLLL',
+        0x10B, 14, 0, raw, 0, 0, 0x1000, 0x1000, 0, 0x400000, 0x1000, 0x200,
+        6, 0, 0, 0, 6, 0, 0, 0x1000 + (raw + 0xFFF) // 0x1000 * 0x1000,
+        0x200, 0, 2, 0, 0x100000, 0x1000, 0x100000, 0x1000, 0, 16)
+    optional += '\x00' * 8 * 16
+    section = struct.pack('<8sLLLLLLHHL', '.text', raw, 0x1000, raw, 0x200,
+                          0, 0, 0, 0, 0x60000020)
+    yield (dos + coff + optional + section).ljust(0x200, '\x00')
+    for block in noise_blocks(rnd, raw):
+        yield block
+
+
+CARRIERS = collections.OrderedDict([
+    ('jpeg', ('jpg', gen_jpeg)),
+    ('png', ('png', gen_png)),
+    ('gif', ('gif', gen_gif)),
+    ('tiff', ('tif', gen_tiff)),
+    ('webm', ('webm', gen_webm)),
+    ('ogg', ('ogg', gen_ogg)),
+    ('flac', ('flac', gen_flac)),
+    ('wav', ('wav', gen_wav)),
+    ('wav_streamed', ('wav', gen_wav_streamed)),
+    ('pdf', ('pdf', gen_pdf)),
+    ('svg', ('svg', gen_svg)),
+    ('xcf', ('xcf', gen_xcf)),
+    ('djvu', ('djvu', gen_djvu)),
+    ('midi', ('mid', gen_midi)),
+    ('pe', ('exe', gen_pe)),
+])
+
+
+# Payloads, a few kilobytes each
+
+def rar_vint(n):
+    out = ''
+    while True:
+        b, n = n & 0x7F, n >> 7
+        if not n:
+            return out + chr(b)
+        out += chr(b | 0x80)
+
+
+def pay_rar(rnd):
+    # RAR 5.0 with one stored file
+    def block(typ, fields, data=''):
+        head = rar_vint(typ) + rar_vint(2 if data else 0)
+        if data:
+            head += rar_vint(len(data))
+        head += fields
+        head = rar_vint(len(head)) + head
+        return struct.pack('<L', zlib.crc32(head) & 0xFFFFFFFF) + head + data
+
+    data = noise(rnd, 4000)
+    name = 'payload.bin'
+    return ('Rar!\x1a\x07\x01\x00' +
+            block(1, rar_vint(0)) +
+            block(2, rar_vint(4) + rar_vint(len(data)) + rar_vint(0x20) +
+                  struct.pack('<L', zlib.crc32(data) & 0xFFFFFFFF) +
+                  rar_vint(0) + rar_vint(0) + rar_vint(len(name)) + name,
+                  data) +
+            block(5, rar_vint(0)))
+
+
+def pay_7z(rnd):
+    packed = noise(rnd, 4000)
+    header = '\x01\x00'  # kHeader, kEnd
+    start = struct.pack('<QQL', len(packed), len(header),
+                        zlib.crc32(header) & 0xFFFFFFFF)
+    return ('7z\xbc\xaf\x27\x1c\x00\x04' +
+            struct.pack('<L', zlib.crc32(start) & 0xFFFFFFFF) + start +
+            packed + header)
+
+
+def pay_cab(rnd):
+    data = noise(rnd, 4000)
+    name = 'payload.bin\x00'
+    files = 36 + 8
+    start = files + 16 + len(name)
+    size = start + 8 + len(data)
+    return (struct.pack('<4sLLLLLBBHHHHH', 'MSCF', 0, size, 0, files, 0,
+                        3, 1, 1, 1, 0, 0, 0) +
+            struct.pack('<LHH', start, 1, 0) +  # CFFOLDER
+            struct.pack('<LLHHHH', len(data), 0, 0, 0x5A21, 0, 0x20) + name +
+            struct.pack('<LHH', 0, len(data), len(data)) + data)
+
+
+def pay_zip(rnd):
+    b = io.BytesIO()
+    z = zipfile.ZipFile(b, 'w', zipfile.ZIP_DEFLATED)
+    for name, data in [('payload.bin', noise(rnd, 4000)),
+                       ('readme.txt', 'payload ' * 200)]:
+        z.writestr(zipfile.ZipInfo(name, (2017, 1, 1, 0, 0, 0)), data)
+    z.close()
+    return b.getvalue()
+
+
+PAYLOADS = collections.OrderedDict([
+    ('clean', None),
+    ('rar', pay_rar),
+    ('7z', pay_7z),
+    ('cab', pay_cab),
+    ('zip', pay_zip),
+])
+
+
+def generate(corpus, formats, sizes, payloads):
+    # Writes the files missing from `corpus` and returns the manifest:
+    # name -> expected payload positions and what the file is
+    manifest_path = os.path.join(corpus, 'manifest.json')
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    except (IOError, ValueError):
+        manifest = {}
+
+    for fmt in formats:
+        ext, gen = CARRIERS[fmt]
+        for size in sizes:
+            names = ['%s_%s_%s.%s' % (fmt, sizeof_fmt(size), payload, ext)
+                     for payload in payloads]
+            if all(name in manifest and
+                   os.path.exists(os.path.join(corpus, name))
+                   for name in names):
+                continue
+
+            # Seeded by what the file is, not by what else is generated
+            rnd = random.Random('%s:%s:%s' % (SEED, fmt, size))
+            carrier = os.path.join(corpus, '%s_%s.tmp' % (fmt, size))
+            length = 0
+            with open(carrier, 'wb') as f:
+                for chunk in gen(rnd, size):
+                    f.write(chunk)
+                    length += len(chunk)
+            if not length:
+                # Too big for this format
+                os.remove(carrier)
+                continue
+
+            for payload, name in zip(payloads, names):
+                path = os.path.join(corpus, name)
+                shutil.copyfile(carrier, path)
+                expected = []
+                if PAYLOADS[payload]:
+                    with open(path, 'ab') as f:
+                        f.write(PAYLOADS[payload](random.Random(
+                            '%s:%s' % (SEED, payload))))
+                    expected.append(length)
+                manifest[name] = {
+                    'format': fmt,
+                    'size': size,
+                    'payload': payload,
+                    'length': os.path.getsize(path),
+                    'expected': expected,
+                }
+            os.remove(carrier)
+
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    return manifest
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(math.ceil(p / 100.0 * len(values))) - 1,
+                      len(values) - 1)] if values else 0
+
+
+def run(corpus, manifest, names, repeat):
+    verdicts = {}
+    samples = collections.defaultdict(list)
+    spans = collections.defaultdict(list)
+    for name in names:
+        path = os.path.join(corpus, name)
+        for i in range(repeat):
+            # Every run must see the file for the first time
+            utils._filetype_cache.clear()
+            try:
+                res, trace = call_traced(detect, path)
+            except Exception as e:
+                res, trace = 'error: %r' % e, []
+            if getattr(res, 'incomplete', None):
+                res = 'error: incomplete, dropped %s' % ', '.join(
+                    res.incomplete)
+            verdicts[name] = res
+            for s in trace:
+                if s['depth'] == 0:
+                    samples[name].append(s)
+                else:
+                    spans[s['stage'], s['detector'] or ''].append(s)
+    return verdicts, samples, spans
+
+
+def check(entry, verdict):
+    if isinstance(verdict, basestring):
+        return 'error'
+    found = set(item['pos'] for item in verdict if not item['middleware'])
+    expected = set(entry['expected'])
+    if found == expected:
+        return 'ok'
+    elif expected - found:
+        return 'missed'
+    return 'extra'
+
+
+def report(manifest, verdicts, samples, spans):
+    def mb(n):
+        return n / float(1 << 20)
+
+    print '%-12s %6s %9s %8s %8s %8s %8s %9s  %s' % (
+        'format', 'files', 'MB/s', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms',
+        'peak MB', 'verdicts')
+    by_format = collections.defaultdict(list)
+    for name in sorted(verdicts):
+        by_format[manifest[name]['format']].append(name)
+    for fmt in CARRIERS:
+        names = by_format.get(fmt)
+        if not names:
+            continue
+        runs = [s for name in names for s in samples[name]]
+        seconds = [s['seconds'] for s in runs]
+        total = sum(s['seconds'] for s in runs)
+        size = sum(manifest[name]['length'] * len(samples[name])
+                   for name in names)
+        results = collections.Counter(check(manifest[name], verdicts[name])
+                                      for name in names)
+        print '%-12s %6d %9.1f %8.1f %8.1f %8.1f %8.1f %9.1f  %s' % (
+            fmt, len(names), mb(size) / total if total else 0,
+            percentile(seconds, 50) * 1000, percentile(seconds, 90) * 1000,
+            percentile(seconds, 99) * 1000, max(seconds) * 1000,
+            mb(max(s['peak_rss'] for s in runs)),
+            ' '.join('%s=%d' % item for item in sorted(results.items())))
+
+    print
+    print '%-10s %-24s %7s %9s %9s %8s %9s' % (
+        'stage', 'detector', 'calls', 'total s', 'MB read', 'p99 ms',
+        'peak MB')
+    for key in sorted(spans):
+        values = spans[key]
+        seconds = [s['seconds'] for s in values]
+        print '%-10s %-24s %7d %9.3f %9.1f %8.1f %9.1f' % (
+            key[0], key[1], len(values), sum(seconds),
+            mb(sum(s['bytes'] for s in values)),
+            percentile(seconds, 99) * 1000,
+            mb(max(s['peak_rss'] for s in values)))
+
+    print
+    for name in sorted(verdicts):
+        result = check(manifest[name], verdicts[name])
+        if result != 'ok':
+            print '%-7s %s' % (result, name)
+
+
+def main(*args):
+    sizes = map(parse_size, SIZES.split(','))
+    formats = list(CARRIERS)
+    payloads = list(PAYLOADS)
+    repeat = REPEAT
+    corpus = save = compare = None
+    for arg in args:
+        if arg.startswith('-sizes:'):
+            sizes = map(parse_size, arg[len('-sizes:'):].split(','))
+        elif arg.startswith('-formats:'):
+            formats = arg[len('-formats:'):].split(',')
+        elif arg.startswith('-payloads:'):
+            payloads = arg[len('-payloads:'):].split(',')
+        elif arg.startswith('-repeat:'):
+            repeat = int(arg[len('-repeat:'):])
+        elif arg.startswith('-corpus:'):
+            corpus = arg[len('-corpus:'):]
+        elif arg.startswith('-save:'):
+            save = arg[len('-save:'):]
+        elif arg.startswith('-compare:'):
+            compare = arg[len('-compare:'):]
+        else:
+            sys.exit('Unknown argument: %s' % arg)
+
+    for fmt in formats:
+        if fmt not in CARRIERS:
+            sys.exit('Unknown format: %s' % fmt)
+    for payload in payloads:
+        if payload not in PAYLOADS:
+            sys.exit('Unknown payload: %s' % payload)
+
+    tmpdir = None
+    if not corpus:
+        corpus = tmpdir = tempfile.mkdtemp()
+    elif not os.path.isdir(corpus):
+        os.makedirs(corpus)
+    try:
+        # Generate in a child, the peak RSS of this process is measured
+        pool = multiprocessing.Pool(1)
+        try:
+            manifest = pool.apply(generate,
+                                  (corpus, formats, sizes, payloads))
+        finally:
+            pool.terminate()
+
+        names = sorted(
+            name for name, entry in manifest.items()
+            if entry['format'] in formats and entry['size'] in sizes and
+            entry['payload'] in payloads)
+        verdicts, samples, spans = run(corpus, manifest, names, repeat)
+        report(manifest, verdicts, samples, spans)
+    finally:
+        if tmpdir:
+            shutil.rmtree(tmpdir)
+
+    # Round trip, so that saved and fresh verdicts compare equal
+    verdicts = json.loads(json.dumps(verdicts))
+    if save:
+        with open(save, 'w') as f:
+            json.dump(verdicts, f, indent=1, sort_keys=True)
+    if compare:
+        with open(compare) as f:
+            stored = json.load(f)
+        changed = sorted(name for name in verdicts
+                         if verdicts[name] != stored.get(name))
+        for name in changed:
+            print 'changed %s' % name
+        if changed:
+            sys.exit('%d verdicts changed' % len(changed))
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
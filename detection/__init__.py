@@ -18,25 +18,65 @@
 from __future__ import absolute_import
 
 import collections
+import hashlib
+import os
 
 from detection.by_ending import detect as ending_detect
 from detection.by_magic import detect as magic_detect
+from detection.metrics import span
 from detection.middleware import detect as middleware_detect
+from detection.utils import as_range
 
 
-def detect(f):
+def source_version():
+    # Changes whenever any of the detection code or data does
+    root = os.path.dirname(os.path.abspath(__file__))
+    sha1 = hashlib.sha1()
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for name in sorted(filenames):
+            if name.endswith(('.py', '.xml')):
+                path = os.path.join(dirpath, name)
+                sha1.update(os.path.relpath(path, root))
+                with open(path, 'rb') as f:
+                    sha1.update(f.read())
+    return sha1.hexdigest()
+
+
+VERSION = source_version()
+
+
+class Detection(list):
+    # The items found. incomplete lists the detectors that did not finish,
+    # killed by the sandbox or skipped by a limit: what they would have found
+    # is missing, so an empty Detection is then no proof of a clean file.
+    def __init__(self, items=(), incomplete=()):
+        super(Detection, self).__init__(items)
+        self.incomplete = list(incomplete)
+
+
+def detect(f, magic_hits=None):
+    f = as_range(f)
+    dropped = []
     ret = collections.defaultdict(lambda: {
         'posexact': False,
         'via': [],
         'mime': ('?/?', '?'),
         'middleware': None
     })
-    for item in ending_detect(f) or []:
+    with span('by_ending'):
+        ending = ending_detect(f, dropped) or []
+    with span('by_magic'):
+        magic = magic_detect(f, magic_hits, dropped) or []
+    with span('middleware'):
+        middleware = middleware_detect(f, dropped) or []
+
+    for item in ending:
         ret[item['pos']]['pos'] = item['pos']
         ret[item['pos']]['posexact'] |= item['posexact']
         ret[item['pos']]['via'].append('Ending')
         ret[item['pos']]['mime'] = item['mime']
-    for item in magic_detect(f) or []:
+    for item in magic:
         ret[item['pos']]['pos'] = item['pos']
         ret[item['pos']]['posexact'] = True
         ret[item['pos']]['via'].append('Magic')
@@ -44,7 +84,7 @@ def detect(f):
     ret = collections.OrderedDict(
         sorted(ret.items(), key=lambda (k, v): k)).values()
 
-    for item in middleware_detect(f) or []:
+    for item in middleware:
         ret.append({
             'pos': item['pos'],
             'posexact': False,
@@ -53,4 +93,4 @@ def detect(f):
             'middleware': item['middleware']
         })
 
-    return ret
+    return Detection(ret, dropped)
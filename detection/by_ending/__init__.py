@@ -17,18 +17,17 @@
 
 from __future__ import absolute_import
 
-import os
-import tempfile
-
-import pywikibot
-
 from detection.by_ending.ffmpeg import strace_detect as ffmpeg_detector
-from detection.by_ending.marker import find_marker, seek_trailers
+from detection.by_ending.marker import (
+    find_last_marker, find_marker, pdf_xref_valid, seek_trailers)
 from detection.by_ending.parsers import ParserDetector
-from detection.by_ending.pefile import detect as pefile_detect
-from detection.by_ending.pillow import detect as pillow_detector
-from detection.by_ending.wave import detect as wave_detector
-from detection.utils import filetype
+from detection.metrics import span
+from detection.sandbox import (
+    DetectorFailed, SandboxError, call as sandbox_call)
+from detection.utils import as_range, filetype, lazy, warning
+
+# PIL is imported only for the files that need it
+pillow_detector = lazy('detection.by_ending.pillow', 'detect')
 
 UNKNOWN_TYPES = ['application/octet-stream', 'text/plain']
 ARCHIVE_TYPES = ['application/rar',
@@ -41,15 +40,52 @@ ARCHIVE_TYPES = ['application/rar',
                  'application/cab', 'application/vnd.ms-cab-compressed',
                  # self-extracting archives
                  'application/dosexec', 'application/msdos-program',
+                 'application/vnd.microsoft.portable-executable',
                  # MIME assigned ourselves
                  'application/x-ffc'
                  ]
 
+# Check the end of JPEG and GIF files found by the parsers with a full
+# decode by Pillow
+PILLOW_VERIFY = False
+
+
+def image_detector(f, minor):
+    parser = ParserDetector(f)
+    detection = parser.parse(minor)
+    if not parser.complete:
+        warning('FIXME: %s parser failed, falling back to Pillow'
+                % minor)
+        return pillow_detector(f)
+
+    if PILLOW_VERIFY:
+        verified = pillow_detector(f)
+        if verified != detection:
+            warning('FIXME: %s parser disagrees with Pillow: '
+                    '%r != %r' % (minor, detection, verified))
+            return verified
+
+    return detection
 
-def detect(f):
+
+def flac_detector(f):
+    parser = ParserDetector(f)
+    detection = parser.parse('flac')
+    if parser.complete:
+        return detection
+
+    warning('FLAC parser failed, falling back to ffmpeg')
+    return ffmpeg_detector(f)
+
+
+def detect(f, dropped=None):
+    # dropped, if given, gets the detectors that did not finish
+    if dropped is None:
+        dropped = []
     trailers = ['\x00', '\x20', '\r', '\n', '\r\n']
 
-    size = os.path.getsize(f)
+    f = as_range(f)
+    size = f.length
 
     major, minor = filetype(f).split('/')
 
@@ -58,9 +94,9 @@ def detect(f):
         'jpg', 'jpeg',
         'gif'
     ]:
-        detector = pillow_detector
+        detector = lambda f: image_detector(f, minor)
     elif minor == 'flac':
-        detector = ffmpeg_detector
+        detector = flac_detector
     elif minor in [
         'ogg',
         'webm',
@@ -70,10 +106,9 @@ def detect(f):
         'tiff',
         'png',
         'midi', 'mid',
+        'wav',
     ]:
         detector = lambda f: ParserDetector(f).parse(minor)
-    elif minor == 'wav':
-        detector = wave_detector
     elif minor == 'pdf':
         # ISO 32000-1:2008
         # 7.5.5. File Trailer
@@ -81,7 +116,7 @@ def detect(f):
         # find the cross-reference table and certain special objects.
         # Conforming readers should read a PDF file from its end. The last
         # line of the file shall contain only the end-of-file marker, %%EOF.
-        detector = find_marker(['%%EOF'], cont=True)
+        detector = find_last_marker('%%EOF', validate=pdf_xref_valid)
     elif minor in ['svg+xml', 'svg', 'xml']:
         # The closing xml tag of svg files
         detector = find_marker([
@@ -89,8 +124,9 @@ def detect(f):
             '</SVG>', '</SVG>\n', '</SVG>\r\n', '</SVG>\r',
         ])
     # PE format. Not executable, but because of the abundance of SFX...
-    elif minor in ['dosexec', 'msdos-program']:
-        detector = pefile_detect
+    elif minor in ['dosexec', 'msdos-program',
+                   'vnd.microsoft.portable-executable']:
+        detector = lambda f: ParserDetector(f).parse('pe')
     elif minor in [typ.split('/')[1] for typ in ARCHIVE_TYPES]:
         # Recursed archival formats
         return
@@ -98,22 +134,29 @@ def detect(f):
         # Recursed unknown formats
         return
     else:
-        pywikibot.warning('FIXME: Unexpected mime: ' + filetype(f))
+        warning('FIXME: Unexpected mime: ' + filetype(f))
         return
     if not detector:
-        pywikibot.warning('FIXME: Unsupported mime: ' + filetype(f))
+        warning('FIXME: Unsupported mime: ' + filetype(f))
         return
 
-    detection = detector(f)
+    with span('by_ending', minor):
+        try:
+            detection = sandbox_call(detector, f)
+        except SandboxError as e:
+            warning('FIXME: %s detector %s' % (minor, e))
+            if not isinstance(e, DetectorFailed):
+                dropped.append(minor)
+            return
     if not detection:
-        pywikibot.warning('FIXME: Failed detection')
+        warning('FIXME: Failed detection')
         return
 
     pos, posexact = detection
     if pos == size:
         return
     elif not pos:
-        pywikibot.warning('FIXME: Failed detection')
+        warning('FIXME: Failed detection')
         return
 
     if minor in ['jpg', 'jpeg']:
@@ -123,33 +166,20 @@ def detect(f):
     if pos == size:
         return
 
-    # Split and analyze
-    chunk_size = 1 << 20
-
-    mime = None
-    with open(f, 'rb') as fin:
-        with tempfile.NamedTemporaryFile() as tmp:
-            fin.seek(pos)
-            while True:
-                read = fin.read(chunk_size)
-                if not read:
-                    break
-                tmp.write(read)
-
-            tmp.flush()
-            # __import__('shutil').copyfile(tmp.name, '/tmp/test')
-            mime = filetype(tmp.name), filetype(tmp.name, False)
-            if mime[0] in UNKNOWN_TYPES:
-                if pos > 0.8 * size:
-                    return
-                if minor == 'jpeg' and pos > 0.5 * size:
-                    return
-            elif size - pos < 512:
-                return
-
-            ret = detect(tmp.name) or []
-            for item in ret:
-                item['pos'] += pos
+    # Analyze the remainder in place
+    tail = f.sub(pos)
+    mime = filetype(tail), filetype(tail, False)
+    if mime[0] in UNKNOWN_TYPES:
+        if pos > 0.8 * size:
+            return
+        if minor == 'jpeg' and pos > 0.5 * size:
+            return
+    elif size - pos < 512:
+        return
+
+    ret = detect(tail, dropped) or []
+    for item in ret:
+        item['pos'] += pos
 
     return [{
         'pos': pos,
@@ -23,10 +23,22 @@ import subprocess
 import tempfile
 
 
+def input_url(f):
+    from detection.utils import as_range
+
+    f = as_range(f)
+    path = os.path.abspath(f.path)
+    if not f.offset:
+        return path
+
+    # Let ffmpeg read the range in place instead of from a copy
+    return 'subfile,,start,%d,end,%d,,:%s' % (
+        f.offset, f.offset + f.length, path)
+
+
 def remux_detect(f):
     from detection.utils import filetype
 
-    f = os.path.abspath(f)
     mime = filetype(f)
     ext = mimetypes.guess_extension(mime, strict=False)
     if ext:
@@ -41,7 +53,7 @@ def remux_detect(f):
         args = ['ffmpeg',
                 '-loglevel', 'warning',
                 '-y',
-                '-i', f,
+                '-i', input_url(f),
                 '-c', 'copy',
                 tmp.name]
         subprocess.call(args)
@@ -53,18 +65,19 @@ def remux_detect(f):
 
 def strace_detect(f):
     from detection.by_ending.utils import SyscallTracer
+    from detection.utils import as_range
 
     # matroska supports (almost?) all codecs
-    f = os.path.abspath(f)
+    f = as_range(f)
     args = ['ffmpeg',
             '-loglevel', 'warning',
             '-y',
-            '-i', f,
+            '-i', input_url(f),
             '-c', 'copy',
             '-f', 'matroska',
             '/dev/null']
 
-    quotedf = "'%s'" % f  # HACK
+    quotedf = "'%s'" % os.path.abspath(f.path)  # HACK
 
     fhs = [None, None]  # [in, out] file handlers
     recordstate = {
@@ -107,4 +120,5 @@ def strace_detect(f):
                                             recordstate['maxpos'])
 
     SyscallTracer(args, syscallHandler).main()
-    return recordstate['maxpos'], False
+    # Positions are traced in the whole file, not the range
+    return max(recordstate['maxpos'] - f.offset, 0), False
@@ -17,12 +17,28 @@
 
 from __future__ import absolute_import
 
+import re
 import traceback
 
-from detection.utils import FileProxy
+from detection.utils import MmapFileProxy, as_range
 
 CHUNK_SIZE = 1 << 16
 
+# How far before %%EOF startxref may be, and into a cross-reference
+# section its trailer or stream dictionary may be
+PDF_TRAILER_SIZE = 1 << 10
+PDF_DICT_SIZE = 1 << 12
+# Incremental updates followed through /Prev before giving up
+PDF_MAX_SECTIONS = 1 << 10
+PDF_STARTXREF = re.compile(r'startxref\s+(\d+)\s*$')
+PDF_XREF_TABLE = re.compile(r'\s*xref\s')
+PDF_XREF_STREAM = re.compile(r'\s*\d+\s+\d+\s+obj\b')
+# Readers repair offsets that are a little off, so a cross-reference
+# section may start this far from where it is pointed at
+PDF_XREF_SLACK = 64
+PDF_XREF_SECTION = re.compile(r'(?<![a-z])xref\s|(?<![\d])\d+\s+\d+\s+obj\b')
+PDF_PREV = re.compile(r'/Prev\s+(\d+)')
+
 
 def search(search, substr, back=True, reverse=False):
     ret = search.rfind(substr) if reverse else search.find(substr)
@@ -37,7 +53,7 @@ def find_marker(markers, startpos=0, cont=False):
         chunks = ('', '')
         lastpos = None
         try:
-            with FileProxy(open(f, 'rb'), track=False) as f:
+            with MmapFileProxy(as_range(f), track=False) as f:
                 while True:
                     r = f.read(CHUNK_SIZE)
                     readpos += len(chunks[0])
@@ -62,38 +78,166 @@ def find_marker(markers, startpos=0, cont=False):
     return detect
 
 
+def rfind_all(f, size, marker):
+    # Positions of `marker` in `f`, last first, reading backward
+    end = size
+    while end > 0:
+        start = max(end - CHUNK_SIZE, 0)
+        f.seek(start)
+        # Overlap the next chunk to catch markers across the boundary
+        window = f.read(end - start + len(marker) - 1)
+        i = window.rfind(marker)
+        while i >= 0:
+            yield start + i
+            i = window.rfind(marker, 0, i + len(marker) - 1)
+        end = start
+
+
+def find_last_marker(marker, validate=None):
+    # Like find_marker(cont=True): the end of the last `marker`, but found
+    # from the end of the file. With `validate`, the last marker for which
+    # validate(f, pos) holds is preferred, if there is any.
+    def detect(f):
+        f = as_range(f)
+        try:
+            with MmapFileProxy(f, track=False) as fp:
+                lastpos = None
+                for pos in rfind_all(fp, f.length, marker):
+                    if validate is None or validate(fp, pos):
+                        return pos + len(marker), True
+                    if lastpos is None:
+                        lastpos = pos + len(marker)
+
+            if lastpos:
+                return lastpos, True
+        except Exception:
+            traceback.print_exc()
+            return
+
+    return detect
+
+
+def find_xref_section(f, offset):
+    # The start of the cross-reference section nearest to `offset`, within
+    # PDF_XREF_SLACK of it, or None
+    start = max(offset - PDF_XREF_SLACK, 0)
+    f.seek(start)
+    # With room for the token starting last
+    window = f.read(offset + 2 * PDF_XREF_SLACK - start)
+    starts = [start + m.start() for m in PDF_XREF_SECTION.finditer(window)
+              if start + m.start() <= offset + PDF_XREF_SLACK]
+    if starts:
+        return min(starts, key=lambda section: abs(section - offset))
+
+
+def pdf_xref_valid(f, pos):
+    # Whether the %%EOF at `pos` ends a PDF: its startxref and the /Prev
+    # chain of incremental updates from there must all point at, or within
+    # PDF_XREF_SLACK of, cross-reference sections before it.
+    f.seek(max(pos - PDF_TRAILER_SIZE, 0))
+    m = PDF_STARTXREF.search(f.read(pos - f.tell()))
+    if not m:
+        return False
+
+    offset = int(m.group(1))
+    seen = set()
+    while True:
+        if offset >= pos or offset in seen or len(seen) >= PDF_MAX_SECTIONS:
+            return False
+        seen.add(offset)
+
+        offset = find_xref_section(f, offset)
+        if offset is None or offset >= pos:
+            return False
+        f.seek(offset)
+        head = f.read(PDF_DICT_SIZE)
+        if PDF_XREF_TABLE.match(head):
+            # The trailer dictionary follows the table
+            trailer = find_forward(f, offset, pos, 'trailer')
+            if trailer is None:
+                return False
+            f.seek(trailer)
+            dictionary = f.read(min(PDF_DICT_SIZE, pos - trailer))
+            dictionary = dictionary.split('startxref', 1)[0]
+        elif PDF_XREF_STREAM.match(head):
+            dictionary = head.split('stream', 1)[0]
+            if '/XRef' not in dictionary:
+                return False
+        else:
+            return False
+
+        m = PDF_PREV.search(dictionary)
+        if not m:
+            return True
+        offset = int(m.group(1))
+
+
+def find_forward(f, start, end, marker):
+    pos = start
+    while pos < end:
+        f.seek(pos)
+        window = f.read(min(CHUNK_SIZE + len(marker) - 1, end - pos))
+        i = window.find(marker)
+        if i >= 0:
+            return pos + i
+        pos += CHUNK_SIZE
+
+
+def trailer_run(trailers):
+    # A function measuring the run of trailers, in any mix, at the start of
+    # a string, and the length of the longest trailer. Units made only of
+    # single byte trailers add nothing and are dropped; runs of the single
+    # bytes are left to str.lstrip, or a regex character class otherwise,
+    # so that they are consumed by C loops.
+    key = tuple(sorted(set(trailers)))
+    try:
+        return _trailer_runs[key]
+    except KeyError:
+        pass
+
+    single = ''.join(t for t in key if len(t) == 1)
+    multi = [t for t in key if len(t) > 1 and t.strip(single)]
+    # Longest first, as alternatives are tried in order
+    multi.sort(key=len, reverse=True)
+
+    if not multi:
+        def measure(r):
+            return len(r) - len(r.lstrip(single))
+    else:
+        alternatives = map(re.escape, multi)
+        if single:
+            alternatives.append('[%s]+' % re.escape(single))
+        run = re.compile('(?:%s)+' % '|'.join(alternatives))
+
+        def measure(r):
+            m = run.match(r)
+            return m.end() if m else 0
+
+    _trailer_runs[key] = measure, max(map(len, key))
+    return _trailer_runs[key]
+
+
+_trailer_runs = {}
+
+
 def seek_trailers(f, pos, trailers):
+    # Skip the run of trailers starting at `pos`
     if not trailers:
         return pos
 
-    trailers.sort(key=lambda i: len(i), reverse=True)
+    measure, longest = trailer_run(trailers)
     try:
-        curtrailer = None
-        with FileProxy(open(f, 'rb'), track=False) as f:
-            f.seek(pos)
-            testdata = f.read(len(trailers[0]))
-            for trailer in trailers:
-                if testdata.startswith(trailer):
-                    curtrailer = trailer
-                    break
-            else:
-                return pos
-
-            size = max(CHUNK_SIZE//len(curtrailer), 1) * len(curtrailer)
-            f.seek(pos)
+        with MmapFileProxy(as_range(f), track=False) as f:
             while True:
-                r = f.read(size)
-
-                for i in range(0, len(r), len(curtrailer)):
-                    if r[i:i+len(curtrailer)] == curtrailer:
-                        pos += len(curtrailer)
-                    else:
-                        return pos
-
-                if not r:
+                f.seek(pos)
+                r = f.read(CHUNK_SIZE)
+                end = measure(r)
+                pos += end
+
+                # Unless a trailer may be cut by the end of the chunk, the
+                # run ends here
+                if len(r) < CHUNK_SIZE or end < len(r) - (longest - 1):
                     return pos
-
-        return pos
     except Exception:
         traceback.print_exc()
         return pos
@@ -0,0 +1,246 @@
+#! /usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General License for more details.
+#
+# You should have received a copy of the GNU General License
+# along with self program.  If not, see <http://www.gnu.org/licenses/>
+#
+
+# The elements of matroska_ebml_specdata.xml by id, converted once so that
+# the XML need not be parsed at import.
+
+matroska_spec = {
+    0x1A45DFA3: {'name': 'EBML', 'level': 0, 'type': 'master'},
+    0x4286: {'name': 'EBMLVersion', 'level': 1, 'type': 'uinteger'},
+    0x42F7: {'name': 'EBMLReadVersion', 'level': 1, 'type': 'uinteger'},
+    0x42F2: {'name': 'EBMLMaxIDLength', 'level': 1, 'type': 'uinteger'},
+    0x42F3: {'name': 'EBMLMaxSizeLength', 'level': 1, 'type': 'uinteger'},
+    0x4282: {'name': 'DocType', 'level': 1, 'type': 'string'},
+    0x4287: {'name': 'DocTypeVersion', 'level': 1, 'type': 'uinteger'},
+    0x4285: {'name': 'DocTypeReadVersion', 'level': 1, 'type': 'uinteger'},
+    0xEC: {'name': 'Void', 'level': -1, 'type': 'binary'},
+    0xBF: {'name': 'CRC-32', 'level': -1, 'type': 'binary'},
+    0x1B538667: {'name': 'SignatureSlot', 'level': -1, 'type': 'master'},
+    0x7E8A: {'name': 'SignatureAlgo', 'level': 1, 'type': 'uinteger'},
+    0x7E9A: {'name': 'SignatureHash', 'level': 1, 'type': 'uinteger'},
+    0x7EA5: {'name': 'SignaturePublicKey', 'level': 1, 'type': 'binary'},
+    0x7EB5: {'name': 'Signature', 'level': 1, 'type': 'binary'},
+    0x7E5B: {'name': 'SignatureElements', 'level': 1, 'type': 'master'},
+    0x7E7B: {'name': 'SignatureElementList', 'level': 2, 'type': 'master'},
+    0x6532: {'name': 'SignedElement', 'level': 3, 'type': 'binary'},
+    0x18538067: {'name': 'Segment', 'level': 0, 'type': 'master'},
+    0x114D9B74: {'name': 'SeekHead', 'level': 1, 'type': 'master'},
+    0x4DBB: {'name': 'Seek', 'level': 2, 'type': 'master'},
+    0x53AB: {'name': 'SeekID', 'level': 3, 'type': 'binary'},
+    0x53AC: {'name': 'SeekPosition', 'level': 3, 'type': 'uinteger'},
+    0x1549A966: {'name': 'Info', 'level': 1, 'type': 'master'},
+    0x73A4: {'name': 'SegmentUID', 'level': 2, 'type': 'binary'},
+    0x7384: {'name': 'SegmentFilename', 'level': 2, 'type': 'utf-8'},
+    0x3CB923: {'name': 'PrevUID', 'level': 2, 'type': 'binary'},
+    0x3C83AB: {'name': 'PrevFilename', 'level': 2, 'type': 'utf-8'},
+    0x3EB923: {'name': 'NextUID', 'level': 2, 'type': 'binary'},
+    0x3E83BB: {'name': 'NextFilename', 'level': 2, 'type': 'utf-8'},
+    0x4444: {'name': 'SegmentFamily', 'level': 2, 'type': 'binary'},
+    0x6924: {'name': 'ChapterTranslate', 'level': 2, 'type': 'master'},
+    0x69FC: {'name': 'ChapterTranslateEditionUID', 'level': 3,
+             'type': 'uinteger'},
+    0x69BF: {'name': 'ChapterTranslateCodec', 'level': 3, 'type': 'uinteger'},
+    0x69A5: {'name': 'ChapterTranslateID', 'level': 3, 'type': 'binary'},
+    0x2AD7B1: {'name': 'TimecodeScale', 'level': 2, 'type': 'uinteger'},
+    0x4489: {'name': 'Duration', 'level': 2, 'type': 'float'},
+    0x4461: {'name': 'DateUTC', 'level': 2, 'type': 'date'},
+    0x7BA9: {'name': 'Title', 'level': 2, 'type': 'utf-8'},
+    0x4D80: {'name': 'MuxingApp', 'level': 2, 'type': 'utf-8'},
+    0x5741: {'name': 'WritingApp', 'level': 2, 'type': 'utf-8'},
+    0x1F43B675: {'name': 'Cluster', 'level': 1, 'type': 'master'},
+    0xE7: {'name': 'Timecode', 'level': 2, 'type': 'uinteger'},
+    0x5854: {'name': 'SilentTracks', 'level': 2, 'type': 'master'},
+    0x58D7: {'name': 'SilentTrackNumber', 'level': 3, 'type': 'uinteger'},
+    0xA7: {'name': 'Position', 'level': 2, 'type': 'uinteger'},
+    0xAB: {'name': 'PrevSize', 'level': 2, 'type': 'uinteger'},
+    0xA3: {'name': 'SimpleBlock', 'level': 2, 'type': 'binary'},
+    0xA0: {'name': 'BlockGroup', 'level': 2, 'type': 'master'},
+    0xA1: {'name': 'Block', 'level': 3, 'type': 'binary'},
+    0xA2: {'name': 'BlockVirtual', 'level': 3, 'type': 'binary'},
+    0x75A1: {'name': 'BlockAdditions', 'level': 3, 'type': 'master'},
+    0xA6: {'name': 'BlockMore', 'level': 4, 'type': 'master'},
+    0xEE: {'name': 'BlockAddID', 'level': 5, 'type': 'uinteger'},
+    0xA5: {'name': 'BlockAdditional', 'level': 5, 'type': 'binary'},
+    0x9B: {'name': 'BlockDuration', 'level': 3, 'type': 'uinteger'},
+    0xFA: {'name': 'ReferencePriority', 'level': 3, 'type': 'uinteger'},
+    0xFB: {'name': 'ReferenceBlock', 'level': 3, 'type': 'integer'},
+    0xFD: {'name': 'ReferenceVirtual', 'level': 3, 'type': 'integer'},
+    0xA4: {'name': 'CodecState', 'level': 3, 'type': 'binary'},
+    0x8E: {'name': 'Slices', 'level': 3, 'type': 'master'},
+    0xE8: {'name': 'TimeSlice', 'level': 4, 'type': 'master'},
+    0xCC: {'name': 'LaceNumber', 'level': 5, 'type': 'uinteger'},
+    0xCD: {'name': 'FrameNumber', 'level': 5, 'type': 'uinteger'},
+    0xCB: {'name': 'BlockAdditionID', 'level': 5, 'type': 'uinteger'},
+    0xCE: {'name': 'Delay', 'level': 5, 'type': 'uinteger'},
+    0xCF: {'name': 'SliceDuration', 'level': 5, 'type': 'uinteger'},
+    0xC8: {'name': 'ReferenceFrame', 'level': 3, 'type': 'master'},
+    0xC9: {'name': 'ReferenceOffset', 'level': 4, 'type': 'uinteger'},
+    0xCA: {'name': 'ReferenceTimeCode', 'level': 4, 'type': 'uinteger'},
+    0xAF: {'name': 'EncryptedBlock', 'level': 2, 'type': 'binary'},
+    0x1654AE6B: {'name': 'Tracks', 'level': 1, 'type': 'master'},
+    0xAE: {'name': 'TrackEntry', 'level': 2, 'type': 'master'},
+    0xD7: {'name': 'TrackNumber', 'level': 3, 'type': 'uinteger'},
+    0x73C5: {'name': 'TrackUID', 'level': 3, 'type': 'uinteger'},
+    0x83: {'name': 'TrackType', 'level': 3, 'type': 'uinteger'},
+    0xB9: {'name': 'FlagEnabled', 'level': 3, 'type': 'uinteger'},
+    0x88: {'name': 'FlagDefault', 'level': 3, 'type': 'uinteger'},
+    0x55AA: {'name': 'FlagForced', 'level': 3, 'type': 'uinteger'},
+    0x9C: {'name': 'FlagLacing', 'level': 3, 'type': 'uinteger'},
+    0x6DE7: {'name': 'MinCache', 'level': 3, 'type': 'uinteger'},
+    0x6DF8: {'name': 'MaxCache', 'level': 3, 'type': 'uinteger'},
+    0x23E383: {'name': 'DefaultDuration', 'level': 3, 'type': 'uinteger'},
+    0x23314F: {'name': 'TrackTimecodeScale', 'level': 3, 'type': 'float'},
+    0x537F: {'name': 'TrackOffset', 'level': 3, 'type': 'integer'},
+    0x55EE: {'name': 'MaxBlockAdditionID', 'level': 3, 'type': 'uinteger'},
+    0x536E: {'name': 'Name', 'level': 3, 'type': 'utf-8'},
+    0x22B59C: {'name': 'Language', 'level': 3, 'type': 'string'},
+    0x86: {'name': 'CodecID', 'level': 3, 'type': 'string'},
+    0x63A2: {'name': 'CodecPrivate', 'level': 3, 'type': 'binary'},
+    0x258688: {'name': 'CodecName', 'level': 3, 'type': 'utf-8'},
+    0x7446: {'name': 'AttachmentLink', 'level': 3, 'type': 'uinteger'},
+    0x3A9697: {'name': 'CodecSettings', 'level': 3, 'type': 'utf-8'},
+    0x3B4040: {'name': 'CodecInfoURL', 'level': 3, 'type': 'string'},
+    0x26B240: {'name': 'CodecDownloadURL', 'level': 3, 'type': 'string'},
+    0xAA: {'name': 'CodecDecodeAll', 'level': 3, 'type': 'uinteger'},
+    0x6FAB: {'name': 'TrackOverlay', 'level': 3, 'type': 'uinteger'},
+    0x6624: {'name': 'TrackTranslate', 'level': 3, 'type': 'master'},
+    0x66FC: {'name': 'TrackTranslateEditionUID', 'level': 4,
+             'type': 'uinteger'},
+    0x66BF: {'name': 'TrackTranslateCodec', 'level': 4, 'type': 'uinteger'},
+    0x66A5: {'name': 'TrackTranslateTrackID', 'level': 4, 'type': 'binary'},
+    0xE0: {'name': 'Video', 'level': 3, 'type': 'master'},
+    0x9A: {'name': 'FlagInterlaced', 'level': 4, 'type': 'uinteger'},
+    0x53B8: {'name': 'StereoMode', 'level': 4, 'type': 'uinteger'},
+    0x53B9: {'name': 'OldStereoMode', 'level': 4, 'type': 'uinteger'},
+    0xB0: {'name': 'PixelWidth', 'level': 4, 'type': 'uinteger'},
+    0xBA: {'name': 'PixelHeight', 'level': 4, 'type': 'uinteger'},
+    0x54AA: {'name': 'PixelCropBottom', 'level': 4, 'type': 'uinteger'},
+    0x54BB: {'name': 'PixelCropTop', 'level': 4, 'type': 'uinteger'},
+    0x54CC: {'name': 'PixelCropLeft', 'level': 4, 'type': 'uinteger'},
+    0x54DD: {'name': 'PixelCropRight', 'level': 4, 'type': 'uinteger'},
+    0x54B0: {'name': 'DisplayWidth', 'level': 4, 'type': 'uinteger'},
+    0x54BA: {'name': 'DisplayHeight', 'level': 4, 'type': 'uinteger'},
+    0x54B2: {'name': 'DisplayUnit', 'level': 4, 'type': 'uinteger'},
+    0x54B3: {'name': 'AspectRatioType', 'level': 4, 'type': 'uinteger'},
+    0x2EB524: {'name': 'ColourSpace', 'level': 4, 'type': 'binary'},
+    0x2FB523: {'name': 'GammaValue', 'level': 4, 'type': 'float'},
+    0x2383E3: {'name': 'FrameRate', 'level': 4, 'type': 'float'},
+    0xE1: {'name': 'Audio', 'level': 3, 'type': 'master'},
+    0xB5: {'name': 'SamplingFrequency', 'level': 4, 'type': 'float'},
+    0x78B5: {'name': 'OutputSamplingFrequency', 'level': 4, 'type': 'float'},
+    0x9F: {'name': 'Channels', 'level': 4, 'type': 'uinteger'},
+    0x7D7B: {'name': 'ChannelPositions', 'level': 4, 'type': 'binary'},
+    0x6264: {'name': 'BitDepth', 'level': 4, 'type': 'uinteger'},
+    0xE2: {'name': 'TrackOperation', 'level': 3, 'type': 'master'},
+    0xE3: {'name': 'TrackCombinePlanes', 'level': 4, 'type': 'master'},
+    0xE4: {'name': 'TrackPlane', 'level': 5, 'type': 'master'},
+    0xE5: {'name': 'TrackPlaneUID', 'level': 6, 'type': 'uinteger'},
+    0xE6: {'name': 'TrackPlaneType', 'level': 6, 'type': 'uinteger'},
+    0xE9: {'name': 'TrackJoinBlocks', 'level': 4, 'type': 'master'},
+    0xED: {'name': 'TrackJoinUID', 'level': 5, 'type': 'uinteger'},
+    0xC0: {'name': 'TrickTrackUID', 'level': 3, 'type': 'uinteger'},
+    0xC1: {'name': 'TrickTrackSegmentUID', 'level': 3, 'type': 'binary'},
+    0xC6: {'name': 'TrickTrackFlag', 'level': 3, 'type': 'uinteger'},
+    0xC7: {'name': 'TrickMasterTrackUID', 'level': 3, 'type': 'uinteger'},
+    0xC4: {'name': 'TrickMasterTrackSegmentUID', 'level': 3, 'type': 'binary'},
+    0x6D80: {'name': 'ContentEncodings', 'level': 3, 'type': 'master'},
+    0x6240: {'name': 'ContentEncoding', 'level': 4, 'type': 'master'},
+    0x5031: {'name': 'ContentEncodingOrder', 'level': 5, 'type': 'uinteger'},
+    0x5032: {'name': 'ContentEncodingScope', 'level': 5, 'type': 'uinteger'},
+    0x5033: {'name': 'ContentEncodingType', 'level': 5, 'type': 'uinteger'},
+    0x5034: {'name': 'ContentCompression', 'level': 5, 'type': 'master'},
+    0x4254: {'name': 'ContentCompAlgo', 'level': 6, 'type': 'uinteger'},
+    0x4255: {'name': 'ContentCompSettings', 'level': 6, 'type': 'binary'},
+    0x5035: {'name': 'ContentEncryption', 'level': 5, 'type': 'master'},
+    0x47E1: {'name': 'ContentEncAlgo', 'level': 6, 'type': 'uinteger'},
+    0x47E2: {'name': 'ContentEncKeyID', 'level': 6, 'type': 'binary'},
+    0x47E3: {'name': 'ContentSignature', 'level': 6, 'type': 'binary'},
+    0x47E4: {'name': 'ContentSigKeyID', 'level': 6, 'type': 'binary'},
+    0x47E5: {'name': 'ContentSigAlgo', 'level': 6, 'type': 'uinteger'},
+    0x47E6: {'name': 'ContentSigHashAlgo', 'level': 6, 'type': 'uinteger'},
+    0x1C53BB6B: {'name': 'Cues', 'level': 1, 'type': 'master'},
+    0xBB: {'name': 'CuePoint', 'level': 2, 'type': 'master'},
+    0xB3: {'name': 'CueTime', 'level': 3, 'type': 'uinteger'},
+    0xB7: {'name': 'CueTrackPositions', 'level': 3, 'type': 'master'},
+    0xF7: {'name': 'CueTrack', 'level': 4, 'type': 'uinteger'},
+    0xF1: {'name': 'CueClusterPosition', 'level': 4, 'type': 'uinteger'},
+    0xF0: {'name': 'CueRelativePosition', 'level': 4, 'type': 'uinteger'},
+    0xB2: {'name': 'CueDuration', 'level': 4, 'type': 'uinteger'},
+    0x5378: {'name': 'CueBlockNumber', 'level': 4, 'type': 'uinteger'},
+    0xEA: {'name': 'CueCodecState', 'level': 4, 'type': 'uinteger'},
+    0xDB: {'name': 'CueReference', 'level': 4, 'type': 'master'},
+    0x96: {'name': 'CueRefTime', 'level': 5, 'type': 'uinteger'},
+    0x97: {'name': 'CueRefCluster', 'level': 5, 'type': 'uinteger'},
+    0x535F: {'name': 'CueRefNumber', 'level': 5, 'type': 'uinteger'},
+    0xEB: {'name': 'CueRefCodecState', 'level': 5, 'type': 'uinteger'},
+    0x1941A469: {'name': 'Attachments', 'level': 1, 'type': 'master'},
+    0x61A7: {'name': 'AttachedFile', 'level': 2, 'type': 'master'},
+    0x467E: {'name': 'FileDescription', 'level': 3, 'type': 'utf-8'},
+    0x466E: {'name': 'FileName', 'level': 3, 'type': 'utf-8'},
+    0x4660: {'name': 'FileMimeType', 'level': 3, 'type': 'string'},
+    0x465C: {'name': 'FileData', 'level': 3, 'type': 'binary'},
+    0x46AE: {'name': 'FileUID', 'level': 3, 'type': 'uinteger'},
+    0x4675: {'name': 'FileReferral', 'level': 3, 'type': 'binary'},
+    0x4661: {'name': 'FileUsedStartTime', 'level': 3, 'type': 'uinteger'},
+    0x4662: {'name': 'FileUsedEndTime', 'level': 3, 'type': 'uinteger'},
+    0x1043A770: {'name': 'Chapters', 'level': 1, 'type': 'master'},
+    0x45B9: {'name': 'EditionEntry', 'level': 2, 'type': 'master'},
+    0x45BC: {'name': 'EditionUID', 'level': 3, 'type': 'uinteger'},
+    0x45BD: {'name': 'EditionFlagHidden', 'level': 3, 'type': 'uinteger'},
+    0x45DB: {'name': 'EditionFlagDefault', 'level': 3, 'type': 'uinteger'},
+    0x45DD: {'name': 'EditionFlagOrdered', 'level': 3, 'type': 'uinteger'},
+    0xB6: {'name': 'ChapterAtom', 'level': 3,
+           'type': 'master', 'recursive': True},
+    0x73C4: {'name': 'ChapterUID', 'level': 4, 'type': 'uinteger'},
+    0x5654: {'name': 'ChapterStringUID', 'level': 4, 'type': 'utf-8'},
+    0x91: {'name': 'ChapterTimeStart', 'level': 4, 'type': 'uinteger'},
+    0x92: {'name': 'ChapterTimeEnd', 'level': 4, 'type': 'uinteger'},
+    0x98: {'name': 'ChapterFlagHidden', 'level': 4, 'type': 'uinteger'},
+    0x4598: {'name': 'ChapterFlagEnabled', 'level': 4, 'type': 'uinteger'},
+    0x6E67: {'name': 'ChapterSegmentUID', 'level': 4, 'type': 'binary'},
+    0x6EBC: {'name': 'ChapterSegmentEditionUID', 'level': 4,
+             'type': 'uinteger'},
+    0x63C3: {'name': 'ChapterPhysicalEquiv', 'level': 4, 'type': 'uinteger'},
+    0x8F: {'name': 'ChapterTrack', 'level': 4, 'type': 'master'},
+    0x89: {'name': 'ChapterTrackNumber', 'level': 5, 'type': 'uinteger'},
+    0x80: {'name': 'ChapterDisplay', 'level': 4, 'type': 'master'},
+    0x85: {'name': 'ChapString', 'level': 5, 'type': 'utf-8'},
+    0x437C: {'name': 'ChapLanguage', 'level': 5, 'type': 'string'},
+    0x437E: {'name': 'ChapCountry', 'level': 5, 'type': 'string'},
+    0x6944: {'name': 'ChapProcess', 'level': 4, 'type': 'master'},
+    0x6955: {'name': 'ChapProcessCodecID', 'level': 5, 'type': 'uinteger'},
+    0x450D: {'name': 'ChapProcessPrivate', 'level': 5, 'type': 'binary'},
+    0x6911: {'name': 'ChapProcessCommand', 'level': 5, 'type': 'master'},
+    0x6922: {'name': 'ChapProcessTime', 'level': 6, 'type': 'uinteger'},
+    0x6933: {'name': 'ChapProcessData', 'level': 6, 'type': 'binary'},
+    0x1254C367: {'name': 'Tags', 'level': 1, 'type': 'master'},
+    0x7373: {'name': 'Tag', 'level': 2, 'type': 'master'},
+    0x63C0: {'name': 'Targets', 'level': 3, 'type': 'master'},
+    0x68CA: {'name': 'TargetTypeValue', 'level': 4, 'type': 'uinteger'},
+    0x63CA: {'name': 'TargetType', 'level': 4, 'type': 'string'},
+    0x63C5: {'name': 'TagTrackUID', 'level': 4, 'type': 'uinteger'},
+    0x63C9: {'name': 'TagEditionUID', 'level': 4, 'type': 'uinteger'},
+    0x63C4: {'name': 'TagChapterUID', 'level': 4, 'type': 'uinteger'},
+    0x63C6: {'name': 'TagAttachmentUID', 'level': 4, 'type': 'uinteger'},
+    0x67C8: {'name': 'SimpleTag', 'level': 3,
+             'type': 'master', 'recursive': True},
+    0x45A3: {'name': 'TagName', 'level': 4, 'type': 'utf-8'},
+    0x447A: {'name': 'TagLanguage', 'level': 4, 'type': 'string'},
+    0x4484: {'name': 'TagDefault', 'level': 4, 'type': 'uinteger'},
+    0x4487: {'name': 'TagString', 'level': 4, 'type': 'utf-8'},
+    0x4485: {'name': 'TagBinary', 'level': 4, 'type': 'binary'},
+}
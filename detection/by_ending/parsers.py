@@ -19,24 +19,84 @@ from __future__ import absolute_import
 
 import os
 import chunk
+import re
 import struct
-import xml.etree.ElementTree as ET
+import zlib
 
-import pywikibot
+from detection.by_ending.matroska_spec import matroska_spec
+from detection.utils import MmapFileProxy, as_range, warning
 
-from detection.utils import FileProxy  # , BinaryFileProxy
+# Descend into Clusters, otherwise they are skipped by their size
+MATROSKA_VALIDATE = False
+MATROSKA_CLUSTER = 0x1F43B675
 
+# Length of an EBML variable size integer by its first byte
+EBML_VINT_LENGTH = [0] + [9 - len(bin(r)) + 2 for r in range(1, 256)]
 
-matroska_spec = os.path.join(
-    os.path.dirname(__file__), 'matroska_ebml_specdata.xml')
-matroska_spec = ET.parse(matroska_spec).getroot()
-matroska_spec = [node.attrib for node in matroska_spec.iter('element')]
-matroska_spec = {int(typ['id'], 0): {
-    'name': typ['name'],
-    'level': int(typ['level']),
-    'id': int(typ['id'], 0),
-    'type': typ['type'],
-} for typ in matroska_spec}
+
+JPEG_WINDOW = 1 << 16
+JPEG_SCAN_END = re.compile(r'\xff[^\x00\xd0-\xd7\xff]')
+
+# Only checked for the last frame unless FLAC_VERIFY_CRC is set
+FLAC_VERIFY_CRC = False
+# Frame size limit if STREAMINFO does not specify one
+FLAC_MAX_FRAME_SIZE = 1 << 22
+# The next frame header is searched for in chunks growing from this size
+# up to the frame size limit, frames are mostly far smaller
+FLAC_SCAN_SIZE = 1 << 16
+
+OGG_VERIFY_CRC = False
+# capture pattern, version, header type, granule position, serial number,
+# sequence number, checksum, page segments
+OGG_PAGE = struct.Struct('<4sBBqLLLB')
+
+# RF64 and BW64 chunk sizes that are to be found in the ds64 chunk
+WAV_SIZE_IN_DS64 = 0xFFFFFFFF
+# FourCC chunk IDs are printable ASCII
+WAV_CHUNK_ID = re.compile(r'[\x20-\x7e]{4}\Z')
+
+# signature, machine, number of sections, time stamp, pointer to symbol
+# table, number of symbols, size of optional header, characteristics
+PE_COFF_HEADER = struct.Struct('<4sHHLLLHH')
+# Offset of the data directories in the optional header, by its magic
+PE_DATA_DIRECTORIES = {0x10B: 96, 0x20B: 112}
+PE_SECTION_HEADER_SIZE = 40
+PE_SYMBOL_SIZE = 18
+PE_CERTIFICATE_TABLE = 4
+
+
+def crc_table(poly, width):
+    table = []
+    top = 1 << (width - 1)
+    mask = (1 << width) - 1
+    for i in range(256):
+        value = i << (width - 8)
+        for j in range(8):
+            value = (value << 1) ^ poly if value & top else value << 1
+        table.append(value & mask)
+    return table
+
+
+def crc8(data):
+    value = 0
+    for r in bytearray(data):
+        value = FLAC_CRC8[value ^ r]
+    return value
+
+
+FLAC_CRC8 = crc_table(0x07, 8)
+FLAC_CRC16 = crc_table(0x8005, 16)
+
+_BITREV8 = ''.join(chr(int('{:08b}'.format(i)[::-1], 2)) for i in range(256))
+
+
+def ogg_crc(data):
+    # CRC-32 with the unreflected polynomial 0x04C11DB7, initial value 0 and
+    # no final xor, through the reflected zlib.crc32 on bit reversed bytes;
+    # the zeros cancel zlib's initial value and final xor.
+    crc = (zlib.crc32(data.translate(_BITREV8)) ^
+           zlib.crc32('\x00' * len(data))) & 0xFFFFFFFF
+    return int('{:032b}'.format(crc)[::-1], 2)
 
 
 class FileCorrupted(Exception):
@@ -45,18 +105,25 @@ class FileCorrupted(Exception):
 
 class ParserDetector(object):
     def __init__(self, f):
-        self.path = f
+        self.file = as_range(f)
         self.lastgoodpos = 0
+        self.complete = False
 
     def parse(self, parsetype):
-        with FileProxy(open(self.path, 'rb'), track=False) as f:
+        with MmapFileProxy(self.file, track=False) as f:
             try:
                 if parsetype == 'ogg':
                     self.parse_ogg(f)
-                # elif parsetype == 'flac':
-                #     self.parse_flac(f)
+                elif parsetype == 'flac':
+                    self.parse_flac(f)
+                elif parsetype in ['jpg', 'jpeg']:
+                    self.parse_jpeg(f)
+                elif parsetype == 'gif':
+                    self.parse_gif(f)
                 elif parsetype == 'webm':
-                    self.parse_ebml(f, matroska_spec, 2)
+                    self.parse_ebml(
+                        f, matroska_spec, 2,
+                        () if MATROSKA_VALIDATE else [MATROSKA_CLUSTER])
                 elif parsetype in ['vnd.djvu', 'djvu']:
                     self.parse_djvu(f)
                 elif parsetype == 'webp':
@@ -69,8 +136,13 @@ class ParserDetector(object):
                     self.parse_png(f)
                 elif parsetype in ['midi', 'mid']:
                     self.parse_midi(f)
+                elif parsetype == 'wav':
+                    self.parse_wav(f)
+                elif parsetype == 'pe':
+                    self.parse_pe(f)
                 else:
                     raise RuntimeError('Wrong parsetype!')
+                self.complete = True
             except (FileCorrupted, ValueError, TypeError, struct.error):
                 __import__('traceback').print_exc()
                 pass
@@ -98,195 +170,439 @@ class ParserDetector(object):
 
         # A page
         while True:
-            # Capture pattern
-            capture = f.read(4)
-            if not capture:
+            header = f.read(OGG_PAGE.size)
+            if not header:
                 break
-            elif capture != 'OggS':
+            (capture, version, flags, granule, serial, sequence, checksum,
+             numsegments) = OGG_PAGE.unpack(header)
+            if capture != 'OggS' or version != 0:
                 raise FileCorrupted
-            # Version
-            if not f.read(1) == '\x00':
-                raise FileCorrupted
-            # Header type
-            f.seek(1, os.SEEK_CUR)
-            # Granule position
-            f.seek(8, os.SEEK_CUR)
-            # Bitstream serial number
-            f.seek(4, os.SEEK_CUR)
-            # Page sequence number
-            f.seek(4, os.SEEK_CUR)
-            # Checksum
-            f.seek(4, os.SEEK_CUR)
-            # Page segments
-            numsegments = ord(f.read(1))
             # Segment table
-            numdatas = [ord(f.read(1)) for i in range(numsegments)]
-            for numdata in numdatas:
-                f.seek(numdata, os.SEEK_CUR)
+            table = f.read(numsegments)
+            if len(table) != numsegments:
+                raise FileCorrupted
+            size = sum(bytearray(table))
+
+            if OGG_VERIFY_CRC:
+                data = f.read(size)
+                if ogg_crc(header[:22] + '\x00' * 4 + header[26:] +
+                           table + data) != checksum:
+                    raise FileCorrupted
+            else:
+                f.seek(size, os.SEEK_CUR)
 
             self.lastgoodpos = f.tell()
 
-    # def parse_flac(self, f):
-    #     # Based on https://xiph.org/flac/format.html
-    #
-    #     if not f.read(4) == 'fLaC':
-    #         raise FileCorrupted
-    #         # But how did the file pass MIME?
-    #
-    #     # METADATA_BLOCK
-    #     while True:
-    #         r = ord(f.read(1))
-    #         last, typ = r & 128, r & 127
-    #         if typ == 127:
-    #             raise FileCorrupted
-    #
-    #         lenblock = reduce(lambda x, r: (x << 8) + r, map(ord, f.read(3)))
-    #         f.seek(lenblock, os.SEEK_CUR)
-    #
-    #         if last:
-    #             break
-    #
-    #     # FRAME
-    #     while True:
-    #         # FRAME_HEADER
-    #         r = reduce(lambda x, r: (x << 8) + r, map(ord, f.read(2)))
-    #         # Sync code
-    #         if r >> 2 != 0b11111111111110:
-    #             raise FileCorrupted
-    #         # Reserved
-    #         r & 0b10
-    #         # Blocking strategy
-    #         variable_blocksize = r & 0b1
-    #
-    #         r = ord(f.read(1))
-    #         # Block size
-    #         blocksize = r >> 4
-    #         # Sample rate
-    #         samplerate = r & 0b1111
-    #         if samplerate == 0b1111:
-    #             raise FileCorrupted
-    #
-    #         r = ord(f.read(1))
-    #         # Channel assignment
-    #         r >> 4
-    #         # Sample size in bits
-    #         (r & 0b1110) >> 1
-    #         # Reserved
-    #         r & 0b1
-    #
-    #         if variable_blocksize:
-    #             f.seek(6, os.SEEK_CUR)
-    #         else:
-    #             f.seek(5, os.SEEK_CUR)
-    #
-    #         if blocksize == 0b0110:
-    #             f.seek(1, os.SEEK_CUR)
-    #         elif blocksize == 0b0111:
-    #             f.seek(2, os.SEEK_CUR)
-    #
-    #         if samplerate == 0b1100:
-    #             f.seek(1, os.SEEK_CUR)
-    #         elif (samplerate & 0b1100) == 0b1100:
-    #             f.seek(2, os.SEEK_CUR)
-    #
-    #         # CRC-8
-    #         f.seek(1, os.SEEK_CUR)
-    #
-    #         # SUBFRAME
-    #         # SUBFRAME_HEADER
-    #         p = BinaryFileProxy(f)
-    #         # Zero bit padding
-    #         if p.read(1):
-    #             raise FileCorrupted
-    #
-    #         # Subframe type
-    #         subframetype = p.read(6)
-    #         if subframetype & 100000:
-    #             # SUBFRAME_LPC
-    #             pass
-    #         elif subframetype & 10000:
-    #             # reserved
-    #             raise FileCorrupted
-    #         elif subframetype & 1000:
-    #             #
-    #             pass
-    #         elif subframetype & 100:
-    #             # reserved
-    #             pass
-    #         elif subframetype & 10:
-    #             # reserved
-    #             pass
-    #         elif subframetype & 1:
-    #             # SUBFRAME_VERBATIM
-    #             pass
-    #         else:
-    #             # SUBFRAME_CONSTANT
-    #             pass
-    #         # FRAME_FOOTER
-    #         f.seek(2, os.SEEK_CUR)
-    #
-    #         break
-
-    def parse_ebml(self, f, spec, n):
-        # Based on http://matroska-org.github.io/libebml/specs.html
+    def parse_jpeg(self, f):
+        # Based on https://www.w3.org/Graphics/JPEG/itu-t81.pdf
+        # and CIPA DC-007 for MPO files
+
+        def try_seek(length, whence=os.SEEK_CUR):
+            pos = f.tell() if whence == os.SEEK_CUR else 0
+            f.seek(length, whence)
+            if f.tell() != pos + length:
+                raise FileCorrupted(length)
+
+        def skip_scan():
+            # Entropy-coded data ends at the first marker that is neither a
+            # stuffed 0xFF00 nor a restart marker
+            pos = f.tell()
+            while True:
+                window = f.read(JPEG_WINDOW)
+                match = JPEG_SCAN_END.search(window)
+                if match:
+                    f.seek(pos + match.start())
+                    return
+                if len(window) < 2:
+                    raise FileCorrupted
+                # the last byte may be the start of a marker
+                pos += len(window) - 1
+                f.seek(pos)
+
+        def mpf_images(base, data):
+            # MP Index IFD of the APP2 MPF segment, offsets are relative to
+            # its TIFF header at `base`
+            order = {'II': '<', 'MM': '>'}.get(data[:2])
+            if not order:
+                raise FileCorrupted
+            offset, = struct.unpack(order+'L', data[4:8])
+            count, = struct.unpack(order+'H', data[offset:offset+2])
+            for i in range(count):
+                entry = data[offset+2+12*i:offset+14+12*i]
+                tag, _, num, value = struct.unpack(order+'HHLL', entry)
+                if tag != 0xB002:
+                    continue
+                for j in range(value, value + num - 15, 16):
+                    size, image = struct.unpack(order+'LL', data[j+4:j+12])
+                    if image:
+                        yield base + image
+
+        def walk(images=None):
+            # One image, from SOI to EOI, whose end it returns. Adds the
+            # starts of the other images of a MPO file to `images`.
+            if f.read(2) != '\xff\xd8':
+                raise FileCorrupted
 
-        def seperate(maxsize, includelead):
-            t = ord(f.read(1))
-            test = 0b10000000
-            for i in range(maxsize):
-                if t & test:
-                    size = i
+            while True:
+                if f.read(1) != '\xff':
+                    raise FileCorrupted
+                marker = f.read(1)
+                while marker == '\xff':
+                    marker = f.read(1)
+                marker = ord(marker)
+
+                if marker == 0xD9:  # EOI
+                    return f.tell()
+                elif 0xD0 <= marker <= 0xD7 or marker == 0x01:
+                    # no parameters
+                    continue
+
+                length, = struct.unpack('>H', f.read(2))
+                if length < 2:
+                    raise FileCorrupted
+                pos = f.tell()
+                if marker == 0xE2 and images is not None:  # APP2
+                    data = f.read(length - 2)
+                    if data.startswith('MPF\x00'):
+                        try:
+                            images.extend(mpf_images(pos + 4, data[4:]))
+                        except struct.error:
+                            pass
+                f.seek(pos)
+                try_seek(length - 2)
+
+                if marker == 0xDA:  # SOS
+                    skip_scan()
+
+        images = []
+        self.lastgoodpos = end = walk(images)
+
+        # The other images of a MPO file follow the first one. The index
+        # is only trusted as far as there are images where it points.
+        for start in sorted(set(images)):
+            if start < end:
+                continue
+            f.seek(start)
+            try:
+                self.lastgoodpos = max(self.lastgoodpos, walk())
+            except (FileCorrupted, TypeError, struct.error):
+                pass
+
+    def parse_gif(self, f):
+        # Based on https://www.w3.org/Graphics/GIF/spec-gif89a.txt
+
+        def try_seek(length, whence=os.SEEK_CUR):
+            pos = f.tell() if whence == os.SEEK_CUR else 0
+            f.seek(length, whence)
+            if f.tell() != pos + length:
+                raise FileCorrupted(length)
+
+        def sub_blocks():
+            while True:
+                size = ord(f.read(1))
+                if not size:
                     break
-                test = (test >> 1)
+                try_seek(size)
+
+        if f.read(6) not in ['GIF87a', 'GIF89a']:
+            raise FileCorrupted
+
+        # Logical Screen Descriptor
+        width, height, flags, bgcolor, aspect = struct.unpack(
+            '<HHBBB', f.read(7))
+        if flags & 0x80:
+            # Global Color Table
+            try_seek(3 << ((flags & 0x07) + 1))
+        self.lastgoodpos = f.tell()
+
+        while True:
+            introducer = f.read(1)
+            if introducer == '\x3b':  # Trailer
+                self.lastgoodpos = f.tell()
+                break
+            elif introducer == '\x21':  # Extension
+                f.read(1)  # label
+                sub_blocks()
+            elif introducer == '\x2c':  # Image Descriptor
+                left, top, width, height, flags = struct.unpack(
+                    '<HHHHB', f.read(9))
+                if flags & 0x80:
+                    # Local Color Table
+                    try_seek(3 << ((flags & 0x07) + 1))
+                # LZW Minimum Code Size
+                f.read(1)
+                sub_blocks()
             else:
                 raise FileCorrupted
 
-            return chr(t if includelead else t & ~test) + f.read(size)
+            self.lastgoodpos = f.tell()
 
-        def parse(lvl):
-            # A node
+    def parse_flac(self, f):
+        # Based on https://xiph.org/flac/format.html
+        #
+        # Frames carry no length field. A frame ends where the next frame
+        # header starts, which is found by its sync code, its CRC-8, and the
+        # frame or sample number that must follow the current one. The last
+        # frame ends where its CRC-16 footer matches.
+
+        def frame_header(pos):
+            f.seek(pos)
+            data = bytearray(f.read(16))
+            if len(data) < 6 or data[0] != 0xFF or data[1] & 0xFE != 0xF8:
+                return
+            variable = data[1] & 0x01
+
+            blocksize, samplerate = data[2] >> 4, data[2] & 0x0F
+            channels, samplesize = data[3] >> 4, (data[3] >> 1) & 0x07
+            if (not blocksize or samplerate == 0b1111 or
+                    channels > 0b1010 or samplesize == 0b011 or
+                    data[3] & 0x01):
+                return
+
+            # Frame or sample number, UTF-8 style coded
+            lead, ones = data[4], 0
+            while ones < 8 and lead & (0x80 >> ones):
+                ones += 1
+            if ones == 1 or ones > 6 + variable:
+                return
+            number = lead & (0xFF >> (ones + 1))
+            i = 4 + max(ones, 1)
+            for r in data[5:i]:
+                if r & 0xC0 != 0x80:
+                    return
+                number = (number << 6) | (r & 0x3F)
+
+            if blocksize == 0b0110:
+                extra_blocksize = data[i:i+1]
+            elif blocksize == 0b0111:
+                extra_blocksize = data[i:i+2]
+            else:
+                extra_blocksize = bytearray()
+            i += len(extra_blocksize)
+            if samplerate == 0b1100:
+                i += 1
+            elif samplerate in (0b1101, 0b1110):
+                i += 2
+
+            if i >= len(data) or crc8(data[:i]) != data[i]:
+                return
+
+            if blocksize == 0b0001:
+                blocksize = 192
+            elif blocksize <= 0b0101:
+                blocksize = 576 << (blocksize - 2)
+            elif blocksize <= 0b0111:
+                blocksize = reduce(lambda x, r: (x << 8) + r,
+                                   extra_blocksize) + 1
+            else:
+                blocksize = 256 << (blocksize - 8)
+
+            return i + 1, variable, number, blocksize
+
+        def next_frame(pos, limit, expect):
+            # The first header from `pos` on, and before `limit`, of the
+            # frame numbered `expect`
+            size = FLAC_SCAN_SIZE
+            while pos < limit:
+                n = min(size, limit - pos)
+                f.seek(pos)
+                window = f.read(n + len(sync) - 1)
+                i = window.find(sync)
+                while i >= 0:
+                    header = frame_header(pos + i)
+                    if header and header[1:3] == (variable, expect):
+                        return pos + i, header
+                    i = window.find(sync, i + 1)
+                if len(window) < n + len(sync) - 1:
+                    break
+                pos += n
+                size *= 2
+            return None, None
+
+        def frame_end(start, limit):
+            # The footer is the CRC-16 of the frame, so check it after every
+            # prefix. A match at the limit wins over an earlier one, which
+            # may just be a coincidence. So may the first of several, then
+            # the end is not known.
+            f.seek(start)
+            data = bytearray(f.read(limit))
+            value, ends = 0, []
+            for i in range(len(data) - 2):
+                value = ((value << 8) & 0xFFFF) ^ \
+                    FLAC_CRC16[(value >> 8) ^ data[i]]
+                if value == (data[i+1] << 8) | data[i+2]:
+                    ends.append(i + 3)
+            if not ends:
+                raise FileCorrupted
+            if ends[-1] == len(data):
+                return start + ends[-1]
+            if len(ends) > 1:
+                raise FileCorrupted
+            return start + ends[0]
+
+        # Tags some encoders put in front
+        if f.read(3) == 'ID3':
+            f.seek(2, os.SEEK_CUR)
+            flags, = struct.unpack('>B', f.read(1))
+            size = reduce(lambda x, r: (x << 7) + (r & 0x7F),
+                          bytearray(f.read(4)))
+            f.seek(size + (10 if flags & 0x10 else 0), os.SEEK_CUR)
+        else:
+            f.seek(0)
 
-            # Element ID
-            nodeid = seperate(4, True)
-            nodeid = reduce(lambda x, r: (x << 8) + r, map(ord, nodeid))
-            # print hex(nodeid)
+        if not f.read(4) == 'fLaC':
+            raise FileCorrupted
 
-            # Data size
-            datasize = seperate(8, False)
-            datasize = reduce(lambda x, r: (x << 8) + r, map(ord, datasize))
-            # print hex(datasize), hex(f.tell())
+        # METADATA_BLOCK
+        streaminfo = None
+        while True:
+            r, = struct.unpack('>B', f.read(1))
+            last, typ = r & 128, r & 127
+            if typ == 127:
+                raise FileCorrupted
+            lenblock, = struct.unpack('>L', '\x00' + f.read(3))
 
-            try:
-                nodetype = spec[nodeid]
-            except KeyError:
-                # These exist, for some reason
-                nodetype = {
-                    'name': '?',
-                    'level': -1,
-                    'id': nodeid,
-                    'type': '?',
-                }
-                # raise FileCorrupted
-
-            # print nodetype['name']
-
-            if nodetype['level'] != lvl and nodetype['level'] > 0:
+            pos = f.tell()
+            if typ == 0:
+                streaminfo = f.read(lenblock)
+            f.seek(pos + lenblock)
+            if f.tell() != pos + lenblock:
                 raise FileCorrupted
 
-            if nodetype['type'] == 'master':
-                pos = f.tell()
-                while f.tell() < pos + datasize:
-                    parse(lvl+1)
-                if f.tell() != pos + datasize:
+            if last:
+                break
+
+        if streaminfo is None or len(streaminfo) < 18:
+            raise FileCorrupted
+        min_framesize, max_framesize = [
+            reduce(lambda x, r: (x << 8) + r, bytearray(streaminfo[i:i+3]))
+            for i in (4, 7)]
+        total_samples = reduce(lambda x, r: (x << 8) + r,
+                               bytearray(streaminfo[13:18])) & (2 ** 36 - 1)
+        max_framesize = max_framesize or FLAC_MAX_FRAME_SIZE
+
+        self.lastgoodpos = start = f.tell()
+        header = frame_header(start)
+        if not header:
+            raise FileCorrupted
+        length, variable, number, blocksize = header
+        sync = '\xff\xf9' if variable else '\xff\xf8'
+        samples = 0
+
+        # FRAME
+        while True:
+            samples += blocksize
+            expect = number + (blocksize if variable else 1)
+
+            if total_samples and samples >= total_samples:
+                self.lastgoodpos = frame_end(start, max_framesize)
+                break
+
+            skip = max(min_framesize, length + 1)
+            end, header = next_frame(start + skip, start + max_framesize + 1,
+                                     expect)
+            if end is None:
+                # No further frame, this is the last one
+                self.lastgoodpos = frame_end(start, max_framesize)
+                break
+
+            if FLAC_VERIFY_CRC and frame_end(start, end - start) != end:
+                raise FileCorrupted
+            self.lastgoodpos = start = end
+            length, variable, number, blocksize = header
+
+    def parse_ebml(self, f, spec, n, skip=()):
+        # Based on http://matroska-org.github.io/libebml/specs.html
+        #
+        # Walks the first `n` top level elements. Master elements with an id
+        # in `skip` are passed over by their size like binary ones, unless
+        # that size is unknown.
+
+        # id -> level, master, recursive
+        table = {nodeid: (typ['level'], typ['type'] == 'master',
+                          typ.get('recursive', False))
+                 for nodeid, typ in spec.items()}
+
+        # Ends of the open master elements, None if of unknown size
+        stack = []
+        started = 0
+        known = False
+
+        def done(pos):
+            # Inside top level elements of unknown size, their last
+            # complete child is the end so far
+            if known and all(end is None for end in stack):
+                self.lastgoodpos = pos
+
+        while True:
+            pos = f.tell()
+            while stack and stack[-1] is not None and pos >= stack[-1]:
+                if pos != stack.pop():
                     raise FileCorrupted
-            else:
-                f.seek(datasize, os.SEEK_CUR)
+                done(pos)
+            if not stack and started == n:
+                break
 
-            if lvl == 0 and nodetype['name'] != '?':
-                self.lastgoodpos = f.tell()
+            data = f.read(12)
+            if not data:
+                # Only elements of unknown size may end with the file
+                if started < n or any(end is not None for end in stack):
+                    raise FileCorrupted
+                break
+
+            # Element ID, with its length marker
+            idlen = EBML_VINT_LENGTH[ord(data[0])]
+            if not idlen or idlen > 4 or len(data) <= idlen:
+                raise FileCorrupted
+            nodeid, = struct.unpack('>L', '\x00' * (4 - idlen) + data[:idlen])
+
+            # Data size, all ones for unknown
+            sizelen = EBML_VINT_LENGTH[ord(data[idlen])]
+            if not sizelen or len(data) < idlen + sizelen:
+                raise FileCorrupted
+            datasize, = struct.unpack(
+                '>Q', '\x00' * (8 - sizelen) + data[idlen:idlen+sizelen])
+            datamask = (1 << 7 * sizelen) - 1
+            datasize &= datamask
+            unknown = datasize == datamask
+
+            # These exist, for some reason
+            level, master, recursive = table.get(nodeid, (-1, False, False))
+
+            def fits():
+                depth = len(stack)
+                if nodeid not in table:
+                    # Only the size of the parent bounds what is not in the
+                    # spec, and payloads start with anything
+                    return not stack or stack[-1] is not None
+                return (level == depth or level < 0 or
+                        recursive and level < depth)
+
+            # Elements of unknown size end where an element that cannot be
+            # their child starts
+            while stack and stack[-1] is None and not fits():
+                stack.pop()
+            if not stack and started == n:
+                break
+            if level > 0 and not fits():
+                raise FileCorrupted
+
+            if not stack:
+                started += 1
+                known = nodeid in table
 
-        for i in range(n):
-            parse(0)
+            start = pos + idlen + sizelen
+            if master and (unknown or nodeid not in skip):
+                f.seek(start)
+                stack.append(None if unknown else start + datasize)
+                continue
+
+            if unknown:
+                raise FileCorrupted
+            f.seek(start + datasize)
+            if f.tell() != start + datasize:
+                raise FileCorrupted
+            done(f.tell())
 
     def parse_djvu(self, f):
         if f.read(4) != 'AT&T':
@@ -518,7 +834,7 @@ class ParserDetector(object):
                     12: (8, 'd'),  # double
                 }.get(field_type, None)
                 if field_type is None:
-                    pywikibot.warning(
+                    warning(
                         'FIXME: TIFF unknown field_type: {}'.format(
                             field_type))
                     type_len, type_code = 1, 'c'
@@ -601,4 +917,123 @@ class ParserDetector(object):
 
         self.read_chunk(f, expect_names=['MThd'])
         while True:
-            self.read_chunk(f, expect_names=['MTrk'])
+            try:
+                self.read_chunk(f, expect_names=['MTrk'])
+            except EOFError:
+                # After the last track
+                break
+
+    def parse_wav(self, f):
+        # Based on the Multimedia Programming Interface and Data
+        # Specifications 1.0 (RIFF), and EBU Tech 3306 (RF64) and
+        # ITU-R BS.2088 (BW64) for files over 4 GiB.
+        #
+        # The chunk headers give the end, the audio data is not read.
+
+        riff, size, wave = struct.unpack('<4sL4s', f.read(12))
+        if riff not in ['RIFF', 'RF64', 'BW64'] or wave != 'WAVE':
+            raise FileCorrupted
+        self.lastgoodpos = f.tell()
+
+        sizes = {}
+        if riff != 'RIFF':
+            # ds64 must be the first chunk
+            name, length = struct.unpack('<4sL', f.read(8))
+            if name != 'ds64' or length < 28:
+                raise FileCorrupted
+            pos = f.tell()
+            size, sizes['data'], samples, count = struct.unpack(
+                '<QQQL', f.read(28))
+            # Table of the other chunks larger than 4 GiB
+            for i in range(min(count, (length - 28) // 12)):
+                name, chunksize = struct.unpack('<4sQ', f.read(12))
+                sizes[name] = chunksize
+            f.seek(pos + length + (length & 1))
+            if f.tell() != pos + length + (length & 1):
+                raise FileCorrupted
+            self.lastgoodpos = f.tell()
+
+        end = 8 + size
+        if size < 4 or end < f.tell() + 8:
+            # Left unset, as by some streaming writers: the chunks go on
+            # to the end of the file
+            end = None
+        while end is None or f.tell() + 8 <= end:
+            header = f.read(8)
+            if len(header) < 8:
+                # the RIFF size is wrong, or the file is truncated
+                break
+            name, length = struct.unpack('<4sL', header)
+            if not WAV_CHUNK_ID.match(name):
+                # Not a chunk, the RIFF size covers something else
+                break
+            if length == WAV_SIZE_IN_DS64 and name in sizes:
+                length = sizes[name]
+
+            pos = f.tell()
+            f.seek(length, os.SEEK_CUR)
+            if f.tell() != pos + length:
+                if name == 'data':
+                    # A truncated recording, the file ends here
+                    self.lastgoodpos = f.tell()
+                break
+            # Pad byte of odd sized chunks, some writers omit the last one
+            if length & 1:
+                f.seek(1, os.SEEK_CUR)
+            self.lastgoodpos = f.tell()
+
+    def parse_pe(self, f):
+        # Based on the Microsoft PE Format specification
+        #
+        # Only the headers are read. The image ends with the furthest of the
+        # raw data of its sections, the certificate table, which is in no
+        # section, and the COFF symbol table with the string table after it.
+
+        if f.read(2) != 'MZ':
+            raise FileCorrupted
+        f.seek(0x3C)
+        pe_offset, = struct.unpack('<L', f.read(4))
+        f.seek(pe_offset)
+        (signature, _, sections, _, symbols, symbol_count, optional_size,
+         _) = PE_COFF_HEADER.unpack(f.read(PE_COFF_HEADER.size))
+        if signature != 'PE\0\0':
+            raise FileCorrupted
+
+        optional = f.read(optional_size)
+        if len(optional) != optional_size:
+            raise FileCorrupted
+        magic, = struct.unpack('<H', optional[:2])
+        if magic not in PE_DATA_DIRECTORIES:
+            raise FileCorrupted
+        directories = PE_DATA_DIRECTORIES[magic]
+        headers_size, = struct.unpack('<L', optional[60:64])
+        directory_count, = struct.unpack(
+            '<L', optional[directories-4:directories])
+
+        table = f.read(sections * PE_SECTION_HEADER_SIZE)
+        if len(table) != sections * PE_SECTION_HEADER_SIZE:
+            raise FileCorrupted
+        ends = [f.tell(), headers_size]
+        for pos in range(0, len(table), PE_SECTION_HEADER_SIZE):
+            raw_size, raw_pointer = struct.unpack(
+                '<LL', table[pos+16:pos+24])
+            if raw_size:
+                ends.append(raw_pointer + raw_size)
+
+        # Its address is a file offset, not a relative virtual address
+        pos = directories + 8 * PE_CERTIFICATE_TABLE
+        if directory_count > PE_CERTIFICATE_TABLE and pos + 8 <= optional_size:
+            address, size = struct.unpack('<LL', optional[pos:pos+8])
+            if size:
+                ends.append(address + size)
+
+        if symbols:
+            strings = symbols + symbol_count * PE_SYMBOL_SIZE
+            f.seek(strings)
+            size = f.read(4)
+            ends.append(strings + (struct.unpack('<L', size)[0]
+                                   if len(size) == 4 else 0))
+
+        # Like f.seek(), stop at the end of a truncated image
+        f.seek(max(ends))
+        self.lastgoodpos = f.tell()
@@ -22,13 +22,13 @@ import traceback
 from PIL import Image
 from PIL import ImageFile
 
-from detection.utils import FileProxy
+from detection.utils import MmapFileProxy, as_range
 
 ImageFile.MAXBLOCK = 1
 
 
 def detect(f):
-    with FileProxy(open(f, 'rb')) as f:
+    with MmapFileProxy(as_range(f)) as f:
         try:
             image = Image.open(f)
 
@@ -20,10 +20,22 @@ from __future__ import absolute_import
 import os
 import struct
 
-from detection.by_magic import register_detector
+from detection.by_magic import MIN_SIZE, register_detector
 
 
-@register_detector('7z\xBC\xAF\x27\x1C')
+def seven_z_header(f):
+    # What seven_z needs: the header it points to is inside the data
+    start = f.tell()
+    f.seek(12, os.SEEK_CUR)
+    NextHeaderOffset, NextHeaderSize = struct.unpack('<QQ', f.read(16))
+    end = 32 + NextHeaderOffset + NextHeaderSize
+    if end < MIN_SIZE:
+        return False
+    f.seek(start + end - 1)
+    return f.read(1) != ''
+
+
+@register_detector('7z\xBC\xAF\x27\x1C', seven_z_header)
 def seven_z(f):
     # Based on
     # https://st.aticpan.org/source/BJOERN/Compress-Deflate7-1.0/7zip/DOC/7zFormat.txt
@@ -17,25 +17,34 @@
 
 from __future__ import absolute_import
 
+import collections
 import os
 import struct
-import tempfile
 import traceback
 
-import pywikibot
-
-from detection.utils import FileProxy, filetype
+from detection.metrics import span
+from detection.sandbox import (
+    DetectorFailed, SandboxError, call as sandbox_call)
+from detection.utils import MmapFileProxy, as_range, filetype, warning
 
 detectors = {}
+# detector: check(f), a few reads in-process that reject hits that are not
+# worth a sandboxed run
+checks = {}
 
 CHUNK_SIZE = 1 << 20
+# Runs per magic and file of hits that pass the check. Beyond that the hits
+# are more likely planted to keep us busy; the result is incomplete.
+MAX_DETECTOR_RUNS = 64
+# Smaller results are no archives worth reporting
+MIN_SIZE = 128
 
 
 class FileCorrupted(Exception):
     pass
 
 
-class UpdatingFileProxy(FileProxy):
+class UpdatingFileProxy(MmapFileProxy):
     def __init__(self, f):
         super(UpdatingFileProxy, self).__init__(f, track=False)
         self.unset_pos()
@@ -46,8 +55,13 @@ class UpdatingFileProxy(FileProxy):
         else:
             self.last_good_pos = pos
 
+    def set_start(self, pos):
+        # For magics at the end of the data, where it begins
+        self.start_pos = pos
+
     def unset_pos(self):
         self.last_good_pos = None
+        self.start_pos = None
 
     def try_seek(self, length, whence=os.SEEK_CUR):
         pos = self.tell() if whence == os.SEEK_CUR else 0
@@ -56,87 +70,183 @@ class UpdatingFileProxy(FileProxy):
             raise FileCorrupted(length)
 
 
-def register_detector(magic):
+def register_detector(magic, check=None):
     def decorator(f):
         detectors[f] = magic
+        if check is not None:
+            checks[f] = check
         return f
     return decorator
 
 
-def findall(string, substr):
-    index = 0
-    length = len(substr)
-    while index < len(string):
-        index = string.find(substr, index)
-        if index == -1:
+class MagicScanner(object):
+    # Finds every occurrence of any of the magics in one pass over the data,
+    # which is fed in consecutive chunks. Hits are (pos, magic) tuples.
+    #
+    # Magics are grouped by their first ANCHOR_SIZE bytes and each chunk is
+    # searched with str.find once per group while it is in memory. This
+    # beats a compiled alternation, which sre matches position by position.
+    ANCHOR_SIZE = 4
+
+    def __init__(self, magics):
+        self.anchors = {}
+        for magic in set(magics):
+            self.anchors.setdefault(
+                magic[:self.ANCHOR_SIZE], []).append(magic)
+        self.overlap = max(map(len, magics)) - 1
+        self.hits = []
+        self.__buf = ''
+        self.__bufpos = 0
+
+    def __scan(self, limit):
+        buf = self.__buf
+        hits = []
+        for anchor, magics in self.anchors.items():
+            # only matches starting before limit
+            end = limit + len(anchor) - 1
+            start = buf.find(anchor, 0, end)
+            while start >= 0:
+                for magic in magics:
+                    if buf.startswith(magic, start):
+                        hits.append((self.__bufpos + start, magic))
+                start = buf.find(anchor, start + 1, end)
+
+        self.hits.extend(sorted(hits))
+        self.__buf = buf[limit:]
+        self.__bufpos += limit
+
+    def feed(self, data):
+        self.__buf += data
+        # Matches may start at most self.overlap bytes before the end of the
+        # buffer, without being complete yet.
+        limit = len(self.__buf) - self.overlap
+        if limit > 0:
+            self.__scan(limit)
+
+    def close(self):
+        self.__scan(len(self.__buf))
+        return self.hits
+
+
+def scanner():
+    return MagicScanner(detectors.values())
+
+
+def scan(f, magics):
+    scanner = MagicScanner(magics)
+    while True:
+        r = f.read(CHUNK_SIZE)
+        if not r:
             break
-        yield index
-        index += length
+        scanner.feed(r)
+    return scanner.close()
 
 
 def find_startpos(f, magic):
-    readpos = 0
-    chunks = ('', '')
-    poss = set()
     try:
-        while True:
-            r = f.read(CHUNK_SIZE)
-            readpos += len(chunks[0])
-            chunks = chunks[1], r
-
-            for pos in findall(''.join(chunks), magic):
-                pos += readpos
-                if pos not in poss:
-                    yield pos
-                    poss.add(pos)
-
-            if not r:
-                break
+        for pos, _ in scan(f, [magic]):
+            yield pos
     except Exception:
         traceback.print_exc()
         return
 
 
-def detect(f):
-    with UpdatingFileProxy(open(f, 'rb')) as f:
+def run_check(check, f):
+    try:
+        return check(f)
+    except (FileCorrupted, IOError, ValueError, TypeError, struct.error):
+        return False
+
+
+def run_detector(detector, f):
+    # The state of f stays in the sandbox, so return what detect() needs
+    try:
+        out = detector(f)
+    except (FileCorrupted, ValueError, TypeError, struct.error):
+        traceback.print_exc()
+        out = True
+    # Ellipsis cannot be pickled
+    return bool(out), out is Ellipsis, f.start_pos, f.last_good_pos
+
+
+def detect(f, hits=None, dropped=None):
+    # hits, if given, are those of a scanner() that has already been fed the
+    # whole file. dropped, if given, gets the detectors that did not finish.
+    if dropped is None:
+        dropped = []
+    magics = {}
+    for detector, magic in detectors.items():
+        magics.setdefault(magic, []).append(detector)
+
+    r = as_range(f)
+    with UpdatingFileProxy(r) as f:
+        if hits is None:
+            try:
+                with span('magic_scan'):
+                    hits = scan(f, magics)
+            except Exception:
+                traceback.print_exc()
+                hits = []
+
         ret = []
-        for detector, magic in detectors.items():
-            f.unset_pos()
-            f.seek(0, os.SEEK_SET)
+        runs = collections.Counter()
+        # Hits before this are inside an archive already found
+        covered = 0
+        for startpos, magic in hits:
+            if startpos < covered:
+                continue
+            for detector in magics[magic]:
+                f.seek(startpos)
+                if detector in checks and not run_check(checks[detector], f):
+                    continue
 
-            # search for magic
-            for startpos in list(find_startpos(f, magic)):
+                runs[magic] += 1
+                if runs[magic] > MAX_DETECTOR_RUNS:
+                    if runs[magic] == MAX_DETECTOR_RUNS + 1:
+                        warning('FIXME: More than %d %s detector runs, '
+                                'skipping the remaining hits'
+                                % (MAX_DETECTOR_RUNS, detector.__name__))
+                        dropped.append(detector.__name__)
+                    continue
+
+                f.unset_pos()
                 # print detector, magic, startpos
                 f.seek(startpos)
                 try:
-                    out = detector(f)
-                except (FileCorrupted, ValueError, TypeError, struct.error):
-                    traceback.print_exc()
-                    out = True
+                    with span('by_magic', detector.__name__):
+                        out, unsized, start, endpos = sandbox_call(
+                            run_detector, detector, f)
+                except SandboxError as e:
+                    warning('FIXME: %s detector %s' % (detector.__name__, e))
+                    if not isinstance(e, DetectorFailed):
+                        dropped.append(detector.__name__)
+                    continue
 
-                endpos = f.last_good_pos
                 if not out or endpos is None:
-                    pywikibot.warning('Really corrupted file?!')
+                    warning('Really corrupted file?!')
                     continue
 
-                size = endpos - startpos
-                if out is not Ellipsis and size < 128:
-                    pywikibot.warning('Very small file?!')
+                if start is None:
+                    start = startpos
+                size = endpos - start
+                if not unsized and size < MIN_SIZE:
+                    warning('Very small file?!')
                     continue
 
-                with tempfile.NamedTemporaryFile() as tmp:
-                    f.seek(startpos)
-                    while True:
-                        read = f.read(CHUNK_SIZE)
-                        if not read:
-                            break
-                        tmp.write(read)
-
-                    tmp.flush()
-                    mime = filetype(tmp.name), filetype(tmp.name, False)
+                if unsized:
+                    tail = r.sub(start)
+                else:
+                    # Only what the detector took, in place
+                    tail = r.sub(start, size)
+                    covered = max(covered, endpos)
+                    if start < startpos:
+                        # Found from its end, after what it contains
+                        ret = [item for item in ret
+                               if not start <= item['pos'] < endpos]
+                mime = filetype(tail), filetype(tail, False)
 
                 ret.append({
-                    'pos': startpos,
+                    'pos': start,
                     'len': size,
                     'mime': mime
                 })
@@ -144,5 +254,5 @@ def detect(f):
         return ret
 
 
-for lib in ['cab', 'rar', '7z']:
+for lib in ['cab', 'rar', '7z', 'zip']:
     __import__('detection.by_magic.' + lib)
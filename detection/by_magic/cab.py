@@ -20,10 +20,21 @@ from __future__ import absolute_import
 import os
 import struct
 
-from detection.by_magic import register_detector, FileCorrupted
+from detection.by_magic import MIN_SIZE, register_detector, FileCorrupted
 
 
-@register_detector('MSCF\x00\x00\x00\x00')
+def cab_header(f):
+    # What ms_cab needs: a cabinet that is large enough and fits
+    start = f.tell()
+    f.seek(8, os.SEEK_CUR)
+    cbCabinet, reserved2 = struct.unpack('<LL', f.read(8))
+    if reserved2 or cbCabinet < MIN_SIZE:
+        return False
+    f.seek(start + cbCabinet - 1)
+    return f.read(1) != ''
+
+
+@register_detector('MSCF\x00\x00\x00\x00', cab_header)
 def ms_cab(f):
     # Based on https://msdn.microsoft.com/en-us/library/bb417343.aspx
     f.seek(8, os.SEEK_CUR)
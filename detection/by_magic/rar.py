@@ -22,8 +22,43 @@ import struct
 
 from detection.by_magic import register_detector, FileCorrupted
 
+# Types of RAR 5.0 headers
+RAR_V5_TYPES = [1, 2, 3, 4, 5, 7]
 
-@register_detector('\x52\x61\x72\x21\x1A\x07\x01\x00')
+
+def rar_v5_header(f):
+    # What rar_v5 needs of the first header: a known type, and that it fits
+    start = f.tell()
+    f.seek(12, os.SEEK_CUR)
+    data = bytearray(f.read(4))
+    if len(data) < 4:
+        return False
+    size = 0
+    for i, b in enumerate(data[:3]):
+        size += (b & 0x7F) << 7 * i
+        if not b & 0x80:
+            break
+    else:
+        return False
+    if not size or data[i+1] & 0x80 or data[i+1] not in RAR_V5_TYPES:
+        return False
+    f.seek(start + 12 + i + 1 + size - 1)
+    return f.read(1) != ''
+
+
+def rar_v4_header(f):
+    # What rar_v4 needs of the block after the marker: a known type, and
+    # that it fits
+    start = f.tell()
+    f.seek(7, os.SEEK_CUR)
+    crc, typ, flags, size = struct.unpack('<HBHH', f.read(7))
+    if not 0x72 <= typ <= 0x7b or size < 7:
+        return False
+    f.seek(start + 7 + size - 1)
+    return f.read(1) != ''
+
+
+@register_detector('\x52\x61\x72\x21\x1A\x07\x01\x00', rar_v5_header)
 def rar_v5(f):
     # based on http://www.rarlab.com/technote.htm
     def vint():
@@ -43,7 +78,7 @@ def rar_v5(f):
         head_size = vint()
         pos = f.tell()
         typ, flags = vint(), vint()
-        if typ not in [1, 2, 3, 4, 5, 7]:
+        if typ not in RAR_V5_TYPES:
             raise FileCorrupted
         extra_area_size = vint() if flags & 0x0001 else 0
         data_size = vint() if flags & 0x0002 else 0
@@ -60,7 +95,7 @@ def rar_v5(f):
     return True
 
 
-@register_detector('\x52\x61\x72\x21\x1A\x07\x00')
+@register_detector('\x52\x61\x72\x21\x1A\x07\x00', rar_v4_header)
 def rar_v4(f):
     # based on http://www.forensicswiki.org/wiki/RAR
     # and http://acritum.com/winrar/rar-format
@@ -0,0 +1,134 @@
+#! /usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General License for more details.
+#
+# You should have received a copy of the GNU General License
+# along with self program.  If not, see <http://www.gnu.org/licenses/>
+#
+
+from __future__ import absolute_import
+
+import os
+import struct
+
+from detection.by_magic import register_detector, FileCorrupted
+
+EOCD = struct.Struct('<4sHHHHLLH')
+ZIP64_LOCATOR = struct.Struct('<4sLQL')
+# Without extensible data, which only PKWARE's strong encryption writes
+ZIP64_EOCD = struct.Struct('<4sQHHLLQQQQ')
+CENTRAL_HEADER = struct.Struct('<4sHHHHHHLLLHHHHHLL')
+
+LOCAL_SIGNATURE = 'PK\x03\x04'
+
+
+def zip64_offset(extra, usize, csize):
+    # The Zip64 extended information extra field has the 64-bit values of
+    # the fields that are 0xFFFFFFFF, in this order
+    pos = 0
+    while pos + 4 <= len(extra):
+        tag, size = struct.unpack('<HH', extra[pos:pos+4])
+        if tag == 0x0001:
+            i = pos + 4 + 8 * ((usize == 0xFFFFFFFF) + (csize == 0xFFFFFFFF))
+            if i + 8 > pos + 4 + size:
+                raise FileCorrupted
+            return struct.unpack('<Q', extra[i:i+8])[0]
+        pos += 4 + size
+    raise FileCorrupted
+
+
+def zip_eocd_header(f):
+    # Not split, and the central directory fits before
+    eocd = f.tell()
+    (_, disk, cd_disk, disk_entries, entries, cd_size, cd_offset,
+     _) = EOCD.unpack(f.read(EOCD.size))
+    if disk or cd_disk or disk_entries != entries:
+        return False
+    # Zip64 has the values elsewhere
+    return 0xFFFFFFFF in (cd_size, cd_offset) or entries == 0xFFFF or \
+        cd_size + cd_offset <= eocd
+
+
+@register_detector('PK\x05\x06', zip_eocd_header)
+def zip_eocd(f):
+    # Based on https://pkware.cachefly.net/webdocs/casestudies/APPNOTE.TXT
+    #
+    # The magic is that of the End of Central Directory record at the end of
+    # the archive. Offsets in the archive are relative to its start, which
+    # follows from the size and offset of the central directory before it.
+    eocd = f.tell()
+    (_, disk, cd_disk, disk_entries, entries, cd_size, cd_offset,
+     comment_len) = EOCD.unpack(f.read(EOCD.size))
+    if disk or cd_disk or disk_entries != entries:
+        # Split archives are not found in one file
+        raise FileCorrupted
+    # A comment cut short by the end of the data still ends the archive
+    f.seek(comment_len, os.SEEK_CUR)
+    end = f.tell()
+
+    cd_end = eocd
+    locator = eocd - ZIP64_LOCATOR.size
+    zip64 = None
+    if locator >= ZIP64_EOCD.size:
+        f.seek(locator)
+        sig, _, zip64, _ = ZIP64_LOCATOR.unpack(f.read(ZIP64_LOCATOR.size))
+        if sig == 'PK\x06\x07':
+            cd_end = locator - ZIP64_EOCD.size
+            f.seek(cd_end)
+            (sig, size, _, _, disk, cd_disk, disk_entries, entries, cd_size,
+             cd_offset) = ZIP64_EOCD.unpack(f.read(ZIP64_EOCD.size))
+            if sig != 'PK\x06\x06' or size != ZIP64_EOCD.size - 12:
+                raise FileCorrupted
+            if disk or cd_disk or disk_entries != entries:
+                raise FileCorrupted
+        else:
+            zip64 = None
+
+    start = cd_end - cd_size - cd_offset
+    if start < 0 or zip64 is not None and start + zip64 != cd_end:
+        raise FileCorrupted
+
+    # Central directory
+    cd_start = cd_end - cd_size
+    f.try_seek(cd_start, os.SEEK_SET)
+    offsets = []
+    for i in xrange(entries):
+        if f.tell() + CENTRAL_HEADER.size > cd_end:
+            raise FileCorrupted
+        (sig, _, _, _, _, _, _, _, csize, usize, name_len, extra_len,
+         comment_len, _, _, _, offset) = CENTRAL_HEADER.unpack(
+             f.read(CENTRAL_HEADER.size))
+        if sig != 'PK\x01\x02':
+            raise FileCorrupted
+        f.try_seek(name_len)
+        extra = f.read(extra_len)
+        f.try_seek(comment_len)
+        if offset == 0xFFFFFFFF:
+            offset = zip64_offset(extra, usize, csize)
+        offsets.append(offset)
+    if f.tell() != cd_end:
+        raise FileCorrupted
+
+    # Each entry must point at a local file header
+    for offset in offsets:
+        if start + offset >= cd_start:
+            raise FileCorrupted
+        f.seek(start + offset)
+        if f.read(4) != LOCAL_SIGNATURE:
+            raise FileCorrupted
+
+    # The first of them is where the archive begins, also when its offsets
+    # count from an earlier point, as after `zip -A`
+    f.set_start(start + min(offsets) if offsets else cd_start)
+    f.update_pos(end)
+
+    return True
@@ -0,0 +1,227 @@
+#! /usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General License for more details.
+#
+# You should have received a copy of the GNU General License
+# along with self program.  If not, see <http://www.gnu.org/licenses/>
+#
+
+# Per-file timing spans of the worker stages and detectors.
+#
+# A Trace collects the spans of one file. It is active on one thread at a
+# time; span() outside of an active trace measures nothing. Detection runs
+# in pool children, which hand their spans back with call_traced(). Bytes
+# read are counted per thread by the file proxies through count_read().
+#
+# Must not import anything from detection, detection.utils imports this.
+
+import collections
+import contextlib
+import json
+import os
+import resource
+import tempfile
+import threading
+import time
+
+# Upper bounds of the Prometheus latency histogram, in seconds
+SECONDS_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60, 300)
+
+_local = threading.local()
+
+
+def count_read(n):
+    try:
+        _local.read += n
+    except AttributeError:
+        _local.read = n
+
+
+def bytes_read():
+    return getattr(_local, 'read', 0)
+
+
+def reset_peak_rss():
+    # Linux >= 4.0: reset VmHWM so peak_rss() covers only what follows
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except (IOError, OSError):
+        pass
+
+
+def peak_rss():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+    # Linux reports kilobytes; peak over the lifetime of the process
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Trace(object):
+    def __init__(self):
+        self.spans = []
+        self.depth = 0
+
+
+def current_trace():
+    return getattr(_local, 'trace', None)
+
+
+@contextlib.contextmanager
+def activate(trace):
+    prev = getattr(_local, 'trace', None)
+    _local.trace = trace
+    try:
+        yield trace
+    finally:
+        _local.trace = prev
+
+
+@contextlib.contextmanager
+def span(stage, detector=None):
+    trace = getattr(_local, 'trace', None)
+    if trace is None:
+        yield
+        return
+
+    record = {
+        'stage': stage,
+        'detector': detector,
+        'depth': trace.depth,
+        'pid': os.getpid(),
+        'start': time.time(),
+    }
+    read = bytes_read()
+    clock = time.time()
+    trace.depth += 1
+    try:
+        yield
+    except Exception:
+        record['error'] = True
+        raise
+    finally:
+        trace.depth -= 1
+        record['seconds'] = time.time() - clock
+        record['bytes'] = bytes_read() - read
+        record['peak_rss'] = peak_rss()
+        trace.spans.append(record)
+
+
+def call_traced(func, *args):
+    # For pool.apply: returns (func(*args), spans)
+    reset_peak_rss()
+    with activate(Trace()) as trace:
+        with span('detect'):
+            ret = func(*args)
+        return ret, trace.spans
+
+
+class Exporter(object):
+    # Aggregates finished traces into Prometheus text-format metrics,
+    # rewritten to `prom_path` after every file for the node_exporter
+    # textfile collector, and appends each trace as a line of NDJSON to
+    # `trace_path`. Either may be None.
+
+    def __init__(self, prom_path=None, trace_path=None):
+        self.prom_path = prom_path
+        self.trace_path = trace_path
+        self.lock = threading.Lock()
+        self.files = 0
+        self.count = collections.Counter()
+        self.seconds = collections.Counter()
+        self.buckets = collections.defaultdict(
+            lambda: [0] * len(SECONDS_BUCKETS))
+        self.bytes = collections.Counter()
+        self.peak_rss = collections.Counter()
+        self.errors = collections.Counter()
+
+    def record(self, trace, **info):
+        with self.lock:
+            self.files += 1
+            for s in trace.spans:
+                key = s['stage'], s['detector'] or ''
+                self.count[key] += 1
+                self.seconds[key] += s['seconds']
+                for i, le in enumerate(SECONDS_BUCKETS):
+                    if s['seconds'] <= le:
+                        self.buckets[key][i] += 1
+                self.bytes[key] += s['bytes']
+                self.peak_rss[key] = max(self.peak_rss[key], s['peak_rss'])
+                if s.get('error'):
+                    self.errors[key] += 1
+
+            if self.trace_path:
+                info['time'] = time.time()
+                info['spans'] = trace.spans
+                with open(self.trace_path, 'a') as f:
+                    f.write(json.dumps(info, sort_keys=True) + '\n')
+
+            if self.prom_path:
+                self.write_prometheus()
+
+    def render(self):
+        def labels(key, **extra):
+            items = [('stage', key[0]), ('detector', key[1])]
+            items += sorted(extra.items())
+            return '{%s}' % ','.join(
+                '%s="%s"' % (k, str(v).replace('\\', '\\\\')
+                             .replace('"', '\\"'))
+                for k, v in items)
+
+        out = [
+            '# HELP detection_files_total Files traced.',
+            '# TYPE detection_files_total counter',
+            'detection_files_total %d' % self.files,
+            '# HELP detection_span_seconds Time spent per stage and '
+            'detector.',
+            '# TYPE detection_span_seconds histogram',
+        ]
+        keys = sorted(self.count)
+        for key in keys:
+            for le, n in zip(SECONDS_BUCKETS, self.buckets[key]):
+                out.append('detection_span_seconds_bucket%s %d'
+                           % (labels(key, le=le), n))
+            out.append('detection_span_seconds_bucket%s %d'
+                       % (labels(key, le='+Inf'), self.count[key]))
+            out.append('detection_span_seconds_sum%s %.6f'
+                       % (labels(key), self.seconds[key]))
+            out.append('detection_span_seconds_count%s %d'
+                       % (labels(key), self.count[key]))
+
+        for name, typ, help, values in [
+            ('detection_span_read_bytes_total', 'counter',
+             'Bytes read from files per stage and detector.', self.bytes),
+            ('detection_span_errors_total', 'counter',
+             'Spans left by an exception.', self.errors),
+            ('detection_span_peak_rss_bytes', 'gauge',
+             'Highest peak RSS seen at the end of a span.', self.peak_rss),
+        ]:
+            out.append('# HELP %s %s' % (name, help))
+            out.append('# TYPE %s %s' % (name, typ))
+            for key in keys:
+                out.append('%s%s %d' % (name, labels(key), values[key]))
+
+        return '\n'.join(out) + '\n'
+
+    def write_prometheus(self):
+        # Atomically, scrapers must never see a partial file
+        dirname = os.path.dirname(os.path.abspath(self.prom_path))
+        fd, tmp = tempfile.mkstemp(dir=dirname)
+        with os.fdopen(fd, 'w') as f:
+            f.write(self.render())
+        os.chmod(tmp, 0o644)
+        os.rename(tmp, self.prom_path)
@@ -17,36 +17,66 @@
 
 from __future__ import absolute_import
 
+import collections
 import traceback
 
-from detection.utils import filetype
+from detection.metrics import span
+from detection.sandbox import (
+    DetectorFailed, SandboxError, call as sandbox_call)
+from detection.utils import as_range, filetype, lazy
 
-middlewares = {}
+# name: (accepts(major, minor), middleware)
+middlewares = collections.OrderedDict()
 
 
-def register_detector(name, accepts):
-    def decorator(f):
-        middlewares[f] = accepts
-        f.middleware_name = name
-        return f
-    return decorator
+def register_detector(name, accepts, module, function):
+    # The module is only imported once accepts() takes a file, so the
+    # dependencies of middlewares that never run are never loaded
+    middlewares[name] = accepts, lazy(module, function)
 
 
-def detect(f):
+register_detector('Remux_Matroska',
+                  lambda major, minor:
+                  major in ['audio', 'video'] and minor not in ['midi', 'mid']
+                  or minor in ['ogg'],
+                  'detection.middleware.ffmpeg', 'ffmpeg_remux_mkv')
+register_detector('Pdfminer_EmbeddedFile',
+                  lambda major, minor: minor == 'pdf',
+                  'detection.middleware.pdfminer', 'pdfminer_EmbeddedFile')
+register_detector('Anti_FFC',
+                  lambda major, minor: major == 'image',
+                  'detection.middleware.ffc', 'anti_ffc')
+
+
+def run_middleware(middleware, f):
+    return list(middleware(f) or [])
+
+
+def detect(f, dropped=None):
+    # dropped, if given, gets the middlewares that were stopped. Those that
+    # raise would do so again on the same file, they count as done.
+    if dropped is None:
+        dropped = []
     ret = []
+    f = as_range(f)
     major, minor = filetype(f).split('/')
 
-    for middleware, accepts in middlewares.items():
+    for name, (accepts, middleware) in middlewares.items():
         if accepts(major, minor):
             try:
-                for item in middleware(f) or []:
-                    item['middleware'] = middleware.middleware_name
-                    ret.append(item)
+                with span('middleware', name):
+                    # Imported here, a sandbox would import it for every file
+                    middleware = middleware.load()
+                    for item in sandbox_call(run_middleware, middleware, f):
+                        item['middleware'] = name
+                        ret.append(item)
+            except DetectorFailed:
+                traceback.print_exc()
+            except SandboxError:
+                # Stopped, it may finish another time
+                traceback.print_exc()
+                dropped.append(name)
             except Exception:
                 traceback.print_exc()
 
     return ret
-
-
-for lib in ['ffmpeg', 'pdfminer', 'ffc']:
-    __import__('detection.middleware.' + lib)
@@ -17,13 +17,23 @@
 
 from __future__ import absolute_import
 
-import itertools
-import os
-import traceback
+import binascii
+import re
 
-from detection.by_magic import find_startpos
-from detection.middleware import register_detector
+from detection.utils import MmapFileProxy
 
+CHUNK_SIZE = 1 << 20
+
+# Two JPEG EOIs, a base64 header of at most 31 quads, the last one maybe
+# padded, a CRLF, then a run of at least 65 more quads
+BASE64 = '[A-Za-z0-9+/]'
+FFC = re.compile(
+    r'\xff\xd9\xff\xd9'
+    r'((?:%(b)s{4}){0,31}(?:%(b)s{3}=|%(b)s{2}==|%(b)s===|====)?)'
+    r'\r\n'
+    r'(?:%(b)s{4}){65}' % {'b': BASE64})
+# FFC never matches more than this
+FFC_MAX_SIZE = 4 + 32 * 4 + 2 + 65 * 4
 
 retdct = {
     'pos': 0,
@@ -31,84 +41,27 @@ retdct = {
 }
 
 
-# @register_detector('Anti_FFC',
-#                    lambda major, minor: minor in ['jpg', 'jpeg'])
-@register_detector('Anti_FFC',
-                   lambda major, minor: True)
 def anti_ffc(f):
-    with open(f, 'rb') as fp:
-        for pos in list(find_startpos(fp, b'\xff\xd9\xff\xd9')):
-            if try_pos(f, pos):
-                return [retdct.copy()]
-
-
-def try_pos(f, pos):
-    with open(f, 'rb') as fp:
-        fp.seek(pos, os.SEEK_SET)
-        if fp.read(4) != b'\xff\xd9\xff\xd9':
-            return
-
-        start = fp.tell()
-        for i in range(32):
-            if not is_base64(fp):
-                length = fp.tell() - start
-                break
-        else:
-            return
-
-        fp.seek(start, os.SEEK_SET)
-        try:
-            header = fp.read(length).decode('base64')
-        except Exception:
-            traceback.print_exc()
-            return
-        if len(header) % 16 != 0 or len(header) <= 16:
-            return
-
-        nl = fp.read(2)
-        if nl == b'\r\n':
-            pass
-        elif len(nl) == 1 and nl in b'\r\n':
-            fp.seek(-1, os.SEEK_CUR)
-        else:
-            return
-
-        for i in itertools.count():
-            if not is_base64(fp):
-                break
-
-        return i > 64
-
-
-valid_base64set = set(map(chr, sum([
-        range(ord(b'0'), ord(b'9')+1),
-        range(ord(b'a'), ord(b'z')+1),
-        range(ord(b'A'), ord(b'Z')+1),
-    ], [])) + [b'+', b'/'])
-assert len(valid_base64set) == 64
-
-
-def is_base64(fp):
-    d = fp.read(4)
-    if len(d) != 4:
-        fp.seek(-len(d), os.SEEK_CUR)
-        return False
-
-    allow_padding = True
-    ended = False
-
-    for char in d[::-1]:
-        if char == b'=' and allow_padding:
-            ended = True
-            continue
-        allow_padding = False
-        if char in valid_base64set:
-            continue
-
-        # Invalid base64
-        fp.seek(-4, os.SEEK_CUR)
+    with MmapFileProxy(f, track=False) as fp:
+        while True:
+            # Chunks overlap so that a match across chunks is found whole,
+            # in the chunk it starts in
+            pos = fp.tell()
+            r = fp.read(CHUNK_SIZE + FFC_MAX_SIZE - 1)
+            for m in FFC.finditer(r):
+                if m.start() >= CHUNK_SIZE:
+                    break
+                if is_ffc_header(m.group(1)):
+                    return [retdct.copy()]
+
+            if len(r) <= CHUNK_SIZE:
+                return
+            fp.seek(pos + CHUNK_SIZE)
+
+
+def is_ffc_header(data):
+    try:
+        header = binascii.a2b_base64(data)
+    except binascii.Error:
         return False
-
-    if ended:
-        return False  # valid but ended
-    return True
+    return len(header) % 16 == 0 and len(header) > 16
@@ -19,20 +19,16 @@ import os
 import subprocess
 import tempfile
 
+from detection.by_ending.ffmpeg import input_url
 from detection.by_magic import detect as magic_detect
-from detection.middleware import register_detector
 
 
-@register_detector('Remux_Matroska',
-                   lambda major, minor:
-                   major in ['audio', 'video'] and minor not in ['midi', 'mid']
-                   or minor in ['ogg'])
 def ffmpeg_remux_mkv(f):
     with tempfile.NamedTemporaryFile(suffix='.mkv') as tmp:
         args = ['ffmpeg',
                 '-loglevel', 'warning',
                 '-y',
-                '-i', f,
+                '-i', input_url(f),
                 '-c', 'copy',
                 tmp.name]
         subprocess.call(args)
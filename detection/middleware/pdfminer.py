@@ -17,69 +17,203 @@
 
 from __future__ import absolute_import
 
-import tempfile
+import io
 import traceback
+import zlib
 
+from pdfminer.ascii85 import ascii85decode, asciihexdecode
+from pdfminer.lzw import LZWDecoder
 from pdfminer.pdfdocument import PDFDocument
 from pdfminer.pdfparser import PDFParser
-from pdfminer.pdftypes import PDFStream
-from pdfminer.psparser import LIT
+from pdfminer.pdftypes import (
+    LITERALS_ASCII85_DECODE, LITERALS_ASCIIHEX_DECODE, LITERALS_FLATE_DECODE,
+    LITERALS_LZW_DECODE, LITERALS_RUNLENGTH_DECODE, PDFObjRef,
+    PDFObjectNotFound, PDFStream, resolve1)
+from pdfminer.psparser import LIT, PSException
+from pdfminer.runlength import rldecode
+from pdfminer.utils import apply_png_predictor
 
 from detection.by_magic import detect as magic_detect
-from detection.middleware import register_detector
-from detection.utils import filetype
+from detection.utils import MAGIC_BYTES, filetype_buffer
 
-LITERAL_FILESPEC = LIT('Filespec')
-LITERAL_EMBEDDEDFILE = LIT('EmbeddedFile')
+LITERAL_FILEATTACHMENT = LIT('FileAttachment')
+# Keys of the EF dictionary of a file specification
+EF_KEYS = ['F', 'UF', 'DOS', 'Mac', 'Unix']
+# Name tree nodes and annotations visited before giving up
+MAX_NODES = 1 << 16
 
 
-# This is modified from
-# https://github.com/euske/pdfminer/blob/44977b6726640933d86028d16ca06fab5ea26d1a/tools/dumppdf.py#L160
-@register_detector('Pdfminer_EmbeddedFile',
-                   lambda major, minor: minor == 'pdf')
-def pdfminer_EmbeddedFile(f):
+def resolve(obj, seen):
+    # Like pdfminer's resolve1, but None for references already followed,
+    # and PDFObjectNotFound for objects missing from the cross-reference
+    # table instead of None
+    while isinstance(obj, PDFObjRef):
+        if obj.objid in seen or len(seen) >= MAX_NODES:
+            return
+        seen.add(obj.objid)
+        obj = obj.doc.getobj(obj.objid)
+    return obj
+
+
+def filespecs(doc):
+    # The file specifications of the EmbeddedFiles name tree and of
+    # FileAttachment annotations
+    seen = set()
+
+    names = resolve(doc.catalog.get('Names'), seen)
+    if isinstance(names, dict):
+        nodes = [names.get('EmbeddedFiles')]
+        while nodes:
+            node = resolve(nodes.pop(), seen)
+            if not isinstance(node, dict):
+                continue
+            kids = resolve(node.get('Kids'), seen)
+            if isinstance(kids, list):
+                nodes.extend(kids)
+            leaves = resolve(node.get('Names'), seen)
+            if isinstance(leaves, list):
+                # [key1 value1 key2 value2 ...]
+                for value in leaves[1::2]:
+                    yield resolve(value, seen)
+
+    # The page tree, no need for PDFPage and its requirements on pages
+    nodes = [doc.catalog.get('Pages')]
+    while nodes:
+        node = resolve(nodes.pop(), seen)
+        if not isinstance(node, dict):
+            continue
+        kids = resolve(node.get('Kids'), seen)
+        if isinstance(kids, list):
+            nodes.extend(kids)
+        annots = resolve(node.get('Annots'), seen)
+        if isinstance(annots, list):
+            for annot in annots:
+                annot = resolve(annot, seen)
+                if (isinstance(annot, dict) and
+                        annot.get('Subtype') is LITERAL_FILEATTACHMENT):
+                    yield resolve(annot.get('FS'), seen)
+
+
+def embedded_streams(doc):
+    seen = set()
+    for spec in filespecs(doc):
+        if not isinstance(spec, dict):
+            continue
+        ef = resolve(spec.get('EF'), set())
+        if not isinstance(ef, dict):
+            continue
+        for key in EF_KEYS:
+            ref = ef.get(key)
+            if isinstance(ref, PDFObjRef):
+                if ref.objid in seen:
+                    continue
+                seen.add(ref.objid)
+            stream = resolve(ref, set())
+            if isinstance(stream, PDFStream):
+                yield stream
+
+
+def unpredict(data, params):
+    # Undoes the PNG predictor that the parameters of a flate or LZW stage
+    # name, if any
+    if not isinstance(params, dict):
+        return data
+    predictor = params.get('Predictor', 1)
+    if not isinstance(predictor, int) or predictor < 10:
+        return data
+    colors = params.get('Colors', 1)
+    columns = params.get('Columns', 1)
+    bpc = params.get('BitsPerComponent', 8)
+    row = 1 + (colors * columns * bpc + 7) // 8
+    return apply_png_predictor(predictor, colors, columns, bpc,
+                               data[:len(data) // row * row])
+
+
+def stream_head(stream, size):
+    # The first `size` bytes of the decoded stream, without decoding the
+    # rest: flate and LZW stop once they produced enough, the other filters
+    # only see a prefix of their input large enough for `size` bytes.
+    data = stream.get_rawdata()
+    if stream.decipher:
+        data = stream.decipher(stream.objid, stream.genno, data)
+
+    # One entry per filter, ISO 32000-1 7.4, or that of the only filter
+    params = resolve1(stream.get_any(('DP', 'DecodeParms', 'FDecodeParms')))
+    if not isinstance(params, list):
+        params = [params]
+
+    for i, f in enumerate(stream.get_filters()):
+        stage_params = resolve1(params[i]) if i < len(params) else None
+        if f in LITERALS_FLATE_DECODE:
+            try:
+                data = zlib.decompressobj().decompress(data, size)
+            except zlib.error:
+                return ''
+            data = unpredict(data, stage_params)
+        elif f in LITERALS_LZW_DECODE:
+            out = []
+            length = 0
+            for chunk in LZWDecoder(io.BytesIO(data)).run():
+                out.append(chunk)
+                length += len(chunk)
+                if length >= size:
+                    break
+            data = unpredict(''.join(out), stage_params)
+        elif f in LITERALS_ASCII85_DECODE:
+            data = ascii85decode(data[:size * 2])
+        elif f in LITERALS_ASCIIHEX_DECODE:
+            data = asciihexdecode(data[:size * 4])
+        elif f in LITERALS_RUNLENGTH_DECODE:
+            data = rldecode(data[:size * 2])
+        else:
+            # Image codecs and crypt filters, nothing to learn here
+            return ''
+
+    return data[:size]
+
+
+def embedded_files(f, fallback):
     ret = []
 
-    with open(f, 'rb') as fp:
+    with f.open() as fp:
         parser = PDFParser(fp)
         doc = PDFDocument(
             parser,
             password='',  # if PDF is protected by password, we know it is evil
-            caching=False  # we can run OOM if we cache all the files
+            caching=False,  # we can run OOM if we cache all the files
+            # Otherwise pdfminer rebuilds the cross-reference table from
+            # every line of the file, even if the file's own is fine
+            fallback=fallback
         )
-        ids = set()
-        for xref in doc.xrefs:
-            ids.update(xref.get_objids())
-        for obj_id in ids:
+        if not doc.catalog:
+            # pdfminer leaves it empty if /Root cannot be found
+            raise PDFObjectNotFound('Root')
+        for stream in embedded_streams(doc):
             try:
-                obj = doc.getobj(obj_id)
+                data = stream_head(stream, MAGIC_BYTES)
             except Exception:
                 traceback.print_exc()
                 continue
-            if (
-                isinstance(obj, PDFStream) and (
-                    obj.get('Type') is LITERAL_EMBEDDEDFILE or
-                    'Params' in obj
-                )
-            ):
-                try:
-                    data = obj.get_data()
-                except Exception:
-                    traceback.print_exc()
-                    continue
 
-                if len(data):
-                    with tempfile.NamedTemporaryFile() as tmp:
-                        tmp.write(data)
-                        tmp.flush()
-                        del obj, data  # save some memory, hopefully
-                        ret.append({
-                            'pos': 0,
-                            'mime': (filetype(tmp.name),
-                                     filetype(tmp.name, False))
-                        })
-
-                        for item in magic_detect(f) or []:
-                            if item['pos']:
-                                ret.append(item)
+            if len(data):
+                ret.append({
+                    'pos': 0,
+                    'mime': (filetype_buffer(data),
+                             filetype_buffer(data, False))
+                })
+    return ret
+
+
+def pdfminer_EmbeddedFile(f):
+    try:
+        ret = embedded_files(f, False)
+    except PSException:
+        # Broken cross-reference table, scan for the objects instead
+        traceback.print_exc()
+        ret = embedded_files(f, True)
+
+    if ret:
+        for item in magic_detect(f) or []:
+            if item['pos']:
+                ret.append(item)
     return ret
@@ -0,0 +1,226 @@
+#! /usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General License for more details.
+#
+# You should have received a copy of the GNU General License
+# along with self program.  If not, see <http://www.gnu.org/licenses/>
+#
+
+# Runs single detectors in a forked child with time and memory limits.
+#
+# A crafted file must not be able to stall or exhaust the worker. The child
+# is killed, with anything it started, when it overruns; the caller gets a
+# SandboxError and goes on with the other detectors. A detector that raises
+# gives DetectorFailed, a SandboxError that says the detector finished: it
+# would fail the same way every time. Forking per call lets detectors be
+# closures and keeps nothing alive between files.
+#
+# A fork only copies the thread that calls it, with the locks that other
+# threads hold at that moment, such as those of logging, pywikibot or
+# libmagic; the child waits for them forever. So the sandbox must only fork
+# in a process with a single thread. Programs with threads call detection
+# in a Helper, which is forked before they start any, and runs one call at
+# a time in its only thread.
+
+from __future__ import absolute_import
+
+import cPickle as pickle
+import errno
+import multiprocessing
+import os
+import resource
+import select
+import signal
+import sys
+import time
+import traceback
+
+from detection.metrics import bytes_read, count_read, current_trace
+
+# Set to False to run detectors in-process, e.g. for debugging
+ENABLED = True
+# Limits per detector call, None for none. The worker sets them from
+# -timeout:, -cputime: and -maxrss:.
+WALL_TIME = 300
+CPU_TIME = 300
+MAX_RSS = 2 << 30
+
+# How often the memory of the child is checked, in seconds
+POLL_INTERVAL = 0.05
+
+
+class SandboxError(Exception):
+    pass
+
+
+class DetectorFailed(SandboxError):
+    pass
+
+
+class HelperDied(SandboxError):
+    pass
+
+
+def rss(pid):
+    # Anonymous memory only: pages of the mmap()ed input file are counted in
+    # VmRSS as well, and those the kernel may drop at any time
+    values = {}
+    try:
+        with open('/proc/%d/status' % pid) as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                if key in ('RssAnon', 'VmRSS'):
+                    values[key] = int(value.split()[0]) * 1024
+    except (IOError, OSError, ValueError):
+        return 0
+    return values.get('RssAnon', values.get('VmRSS', 0))
+
+
+def child(func, args, w):
+    status = 1
+    try:
+        os.setpgrp()
+        if CPU_TIME is not None:
+            # SIGXCPU at the soft limit, SIGKILL one second later
+            resource.setrlimit(resource.RLIMIT_CPU, (CPU_TIME, CPU_TIME + 1))
+
+        trace = current_trace()
+        spans = len(trace.spans) if trace else 0
+        read = bytes_read()
+        try:
+            ret = True, func(*args)
+        except MemoryError:
+            # Depends on the load of the machine, dies like an overrun
+            raise
+        except Exception:
+            ret = False, traceback.format_exc()
+
+        data = pickle.dumps(
+            (ret, trace.spans[spans:] if trace else [], bytes_read() - read),
+            pickle.HIGHEST_PROTOCOL)
+        while data:
+            data = data[os.write(w, data):]
+        status = 0
+    except BaseException:
+        traceback.print_exc()
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(status)
+
+
+def call(func, *args):
+    # func(*args) in a child process. Exceptions of func raise
+    # DetectorFailed, overruns and crashes of the child SandboxError.
+    if not ENABLED:
+        return func(*args)
+
+    r, w = os.pipe()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid = os.fork()
+    if not pid:
+        os.close(r)
+        child(func, args, w)
+    os.close(w)
+    try:
+        # Also here, in case the child has not got to it before a kill
+        os.setpgid(pid, pid)
+    except OSError:
+        pass
+
+    start = time.time()
+    chunks = []
+    error = None
+    done = False
+    try:
+        while True:
+            try:
+                ready, _, _ = select.select([r], [], [], POLL_INTERVAL)
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if ready:
+                data = os.read(r, 1 << 16)
+                if not data:
+                    done = True
+                    break
+                chunks.append(data)
+
+            if WALL_TIME is not None and time.time() - start > WALL_TIME:
+                error = 'exceeded %s s wall time' % WALL_TIME
+                break
+            if MAX_RSS is not None and rss(pid) > MAX_RSS:
+                error = 'exceeded %d MiB of memory' % (MAX_RSS >> 20)
+                break
+    finally:
+        os.close(r)
+        if not done:
+            try:
+                os.killpg(pid, signal.SIGKILL)
+            except OSError:
+                pass
+        _, status = os.waitpid(pid, 0)
+
+    if error is not None:
+        raise SandboxError(error)
+    if os.WIFSIGNALED(status):
+        raise SandboxError('killed by signal %d' % os.WTERMSIG(status))
+    if os.WEXITSTATUS(status) or not chunks:
+        raise SandboxError('died')
+
+    (ok, ret), spans, read = pickle.loads(''.join(chunks))
+    trace = current_trace()
+    if trace:
+        trace.spans += spans
+    count_read(read)
+    if not ok:
+        raise DetectorFailed('failed:\n' + ret)
+    return ret
+
+
+def serve(conn):
+    while True:
+        try:
+            func, args = conn.recv()
+        except EOFError:
+            return
+        try:
+            ret = True, func(*args)
+        except Exception:
+            ret = False, traceback.format_exc()
+        conn.send(ret)
+
+
+class Helper(object):
+    # A process that calls functions for this one, see above. Create it
+    # before any thread is started; one that died cannot be replaced then
+    # and raises HelperDied.
+    def __init__(self):
+        self.conn, conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=serve, args=(conn,))
+        self.process.daemon = True
+        self.process.start()
+        conn.close()
+
+    def call(self, func, *args):
+        # func(*args) in the helper, which must be able to pickle them
+        try:
+            self.conn.send((func, args))
+            ok, ret = self.conn.recv()
+        except (EOFError, IOError):
+            self.process.join(1)
+            raise HelperDied('exit code %s' % self.process.exitcode)
+        if not ok:
+            raise SandboxError('failed:\n' + ret)
+        return ret
@@ -15,107 +15,207 @@
 # along with self program.  If not, see <http://www.gnu.org/licenses/>
 #
 
+import collections
+import errno
+import importlib
+import mmap
 import os
 import subprocess
 
+from detection.metrics import count_read, span
+from lru import LRUCache
 
-def filetype(path, mime=True):
-    args = ['file', path, '-b']
+try:
+    import magic
+except ImportError:
+    magic = None
+
+# libmagic never looks further than this into a file
+MAGIC_BYTES = 1 << 20
+FILETYPE_CACHE_SIZE = 256
+
+
+def warning(text):
+    # pywikibot takes long to import, tools that only detect may never need
+    # it
+    import pywikibot
+    pywikibot.warning(text)
+
+
+def lazy(module, name):
+    # Stands in for `name` of `module`, which is imported, with whatever it
+    # depends on, on the first call or load()
+    def load():
+        return getattr(importlib.import_module(module), name)
+
+    def call(*args, **kwargs):
+        return load()(*args, **kwargs)
+    call.__name__ = name
+    call.load = load
+    return call
+
+
+_filetype_cache = LRUCache(FILETYPE_CACHE_SIZE)
+_magic_instances = {}
+
+
+def _libmagic(mime):
+    if mime not in _magic_instances:
+        _magic_instances[mime] = magic.Magic(mime=mime)
+    return _magic_instances[mime]
+
+
+def _file_args(mime):
+    args = ['file', '-b']
     if mime:
         # not '-i' because we don't need '; charset=binary'
         args.append('--mime-type')
+    return args
 
-    val = subprocess.check_output(args).strip()
 
+def _rewrite(val, mime):
+    val = val.strip()
     if mime:
         val = val.replace('/x-', '/')
     return val
 
 
-class FileProxy(object):
-    CHUNK_SIZE = 1 << 20
+def filetype(f, mime=True):
+    f = as_range(f)
+    st = os.stat(f.path)
+    key = f.path, st.st_ino, st.st_mtime, f.offset, f.length, mime
+    try:
+        return _filetype_cache[key]
+    except KeyError:
+        pass
+
+    with span('filetype'):
+        if f.offset or f.length != st.st_size:
+            with f.open() as fp:
+                val = filetype_buffer(fp.read(MAGIC_BYTES), mime)
+        elif magic is not None:
+            val = _rewrite(_libmagic(mime).from_file(f.path), mime)
+        else:
+            val = _rewrite(subprocess.check_output(
+                _file_args(mime) + [f.path]), mime)
+
+    _filetype_cache[key] = val
+    return val
+
+
+def filetype_buffer(buf, mime=True):
+    buf = buf[:MAGIC_BYTES]
+    if magic is not None:
+        val = _libmagic(mime).from_buffer(buf)
+    else:
+        proc = subprocess.Popen(_file_args(mime) + ['-'],
+                                stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        val, _ = proc.communicate(buf)
+        if proc.returncode:
+            raise subprocess.CalledProcessError(proc.returncode, 'file')
+    return _rewrite(val, mime)
+
+
+class FileRange(collections.namedtuple('FileRange', 'path offset length')):
+    # A view of `length` bytes of the file at `path`, starting at `offset`.
+    # Detection recurses into the data after a carrier by narrowing the view
+    # instead of copying that data elsewhere.
+    __slots__ = ()
+
+    def open(self):
+        return SubFileProxy(open(self.path, 'rb'), self.offset, self.length)
+
+    def sub(self, offset, length=None):
+        if length is None:
+            length = self.length - offset
+        return FileRange(self.path, self.offset + offset, length)
+
+
+def as_range(f):
+    if isinstance(f, FileRange):
+        return f
+    return FileRange(f, 0, os.path.getsize(f))
+
+
+class MmapFileProxy(object):
+    # A read-only file over the FileRange `f`, or the whole file object `f`
+    # from where it is, which the proxy closes. The data is mapped into
+    # memory: seeks are free and reads are slices of the mapping.
+    #
+    # _maxseek is the furthest position reached, unless `track` is False.
 
     def __init__(self, f, track=True):
-        self.__f = f
-        self.__pos = self._maxseek = f.tell()
-        self.__chunkpos = None
-        self.__load_chunk()
+        if isinstance(f, FileRange):
+            self.__f = open(f.path, 'rb')
+            offset, self.__size, self.__pos = f.offset, f.length, 0
+        else:
+            self.__f = f
+            offset, self.__size = 0, os.fstat(f.fileno()).st_size
+            self.__pos = f.tell()
+        self._maxseek = self.__pos
+
+        # mmap offsets must be aligned
+        base = offset - offset % mmap.ALLOCATIONGRANULARITY
+        self.__delta = offset - base
+        if self.__size:
+            self.__map = mmap.mmap(self.__f.fileno(),
+                                   self.__delta + self.__size,
+                                   access=mmap.ACCESS_READ, offset=base)
+        else:
+            self.__map = None  # mmap cannot map an empty range
 
         if not track:
             self.__update = lambda: None
 
-    def __load_chunk(self):
-        base, ext = divmod(self.__pos, self.CHUNK_SIZE)
-        base *= self.CHUNK_SIZE
-        if self.__chunkpos == base:
-            return
-
-        self.__chunkpos = base
-        self.__f.seek(base)
-        tell = self.__f.tell()
-        self.chunk = self.__f.read(self.CHUNK_SIZE)
-        self.__pos = tell + min(len(self.chunk), ext)
-
     def __update(self):
-        self._maxseek = max(self.tell(), self._maxseek)
+        self._maxseek = max(self.__pos, self._maxseek)
 
     def read(self, size=-1):
-        # print 'read', size
-        ret = ''
         if size < 0:
-            while True:
-                ext = self.__pos % self.CHUNK_SIZE
-                r = self.chunk[ext:]
-                self.__pos += len(r)
-                self.__load_chunk()
-                ret += r
-                if not r:
-                    break
-        elif size == 1:
-            ext = self.__pos % self.CHUNK_SIZE
-            ret = self.chunk[ext:ext+1]
-            self.__pos += 1
-            self.__load_chunk()
-        elif size > 0:
+            end = self.__size
+        else:
+            end = min(self.__pos + size, self.__size)
+
+        if self.__pos >= end:
             ret = ''
-            while size:
-                ext = self.__pos % self.CHUNK_SIZE
-                r = self.chunk[ext:ext+size]
-                self.__pos += len(r)
-                size -= len(r)
-                self.__load_chunk()
-                ret += r
-                if not r or not size:
-                    break
+        else:
+            ret = self.__map[self.__delta+self.__pos:self.__delta+end]
+            self.__pos = end
+            count_read(len(ret))
 
         self.__update()
         return ret
 
     def readline(self):
-        ret = ''
-        while True:
-            r = self.read(1)
-            ret += r
-            if not r or r == '\n':
-                break
-        return ret
+        if self.__pos >= self.__size:
+            return ''
+
+        end = self.__map.find('\n', self.__delta + self.__pos,
+                              self.__delta + self.__size)
+        if end < 0:
+            return self.read()
+        return self.read(end - self.__delta + 1 - self.__pos)
 
     def seek(self, offset, whence=os.SEEK_SET):
-        # print 'seek', offset, whence
         if whence == os.SEEK_SET:
-            self.__pos = offset
+            pos = offset
         elif whence == os.SEEK_CUR:
-            self.__pos += offset
+            pos = self.__pos + offset
         elif whence == os.SEEK_END:
             raise NotImplementedError  # This breaks the whole detection logic
-        self.__load_chunk()
+
+        if pos < 0:
+            raise IOError(errno.EINVAL, os.strerror(errno.EINVAL))
+        # Like a file, but stop at the end of the data
+        self.__pos = min(pos, self.__size)
         self.__update()
 
     def tell(self):
-        # print 'tell', self.__pos
         return self.__pos
 
     def close(self):
+        if self.__map is not None:
+            self.__map.close()
         return self.__f.close()
 
     def __enter__(self):
@@ -176,11 +276,15 @@ class SubFileProxy(object):
         f.seek(start)
 
     def read(self, size=-1):
+        remaining = max(self.__end - self.__f.tell(), 0)
         if size < 0:
-            return self.__f.read(self.__end - self.__f.tell())
+            ret = self.__f.read(remaining)
         elif size > 0:
-            return self.__f.read(min(size, self.__end - self.__f.tell()))
-        return ''
+            ret = self.__f.read(min(size, remaining))
+        else:
+            ret = ''
+        count_read(len(ret))
+        return ret
 
     def seek(self, offset, whence=os.SEEK_SET):
         if whence == os.SEEK_SET:
@@ -0,0 +1,127 @@
+#! /usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General License for more details.
+#
+# You should have received a copy of the GNU General License
+# along with self program.  If not, see <http://www.gnu.org/licenses/>
+#
+
+# Edit counts of uploaders, cached in memory and shared through Redis by
+# the watcher and the workers.
+#
+# Batch uploaders push thousands of files, and are skipped for having
+# more than TRUSTED_EDIT_COUNT edits. Edit counts only grow, so trusted
+# users are kept for TRUSTED_TTL; the others are asked again after
+# EDIT_COUNT_TTL, they may become trusted.
+
+import json
+import threading
+import time
+
+from config import REDIS_KEY
+from lru import LRUCache
+
+# Uploads of users with more edits are not checked
+TRUSTED_EDIT_COUNT = 200
+
+# Seconds until edit counts are refreshed, 0 not to cache them; set by
+# -editcountttl: and -trustedttl:
+EDIT_COUNT_TTL = 3600
+TRUSTED_TTL = 7 * 24 * 3600
+
+# Users kept in memory per process
+CACHE_SIZE = 4096
+# Users per list=users query without the apihighlimits right
+USERS_PER_QUERY = 50
+
+
+def ttl(count):
+    return TRUSTED_TTL if count > TRUSTED_EDIT_COUNT else EDIT_COUNT_TTL
+
+
+class EditCounts(object):
+    def __init__(self, site, redis):
+        self.site = site
+        self.redis = redis
+        self.lock = threading.Lock()
+        self.local = LRUCache(CACHE_SIZE)
+
+    def key(self, name):
+        return '%s:editcount:%s' % (REDIS_KEY, name)
+
+    def cached(self, names):
+        # (edit counts by name, names not in either cache)
+        now = time.time()
+        counts = {}
+        missing = []
+        with self.lock:
+            for name in names:
+                try:
+                    count, expiry = self.local[name]
+                except KeyError:
+                    expiry = 0
+                if expiry > now:
+                    counts[name] = count
+                else:
+                    missing.append(name)
+        if not missing:
+            return counts, missing
+
+        values = self.redis.mget([self.key(name) for name in missing])
+        names, missing = missing, []
+        for name, value in zip(names, values):
+            # With the expiry, so that it is the same in all processes
+            count, expiry = json.loads(value) if value else (None, 0)
+            if expiry <= now:
+                missing.append(name)
+                continue
+            counts[name] = count
+            with self.lock:
+                self.local[name] = count, expiry
+        return counts, missing
+
+    def store(self, counts):
+        now = time.time()
+        pipe = self.redis.pipeline(transaction=False)
+        for name, count in counts.items():
+            if ttl(count) <= 0:
+                continue
+            expiry = now + ttl(count)
+            with self.lock:
+                self.local[name] = count, expiry
+            pipe.set(self.key(name), json.dumps([count, expiry]),
+                     ex=ttl(count))
+        pipe.execute()
+
+    def fetch(self, names):
+        counts = {}
+        for i in range(0, len(names), USERS_PER_QUERY):
+            res = self.site._simple_request(
+                action='query',
+                list='users',
+                usprop='editcount',
+                ususers=names[i:i+USERS_PER_QUERY]
+            ).submit()
+            # Without editcount if missing or an IP
+            for user in res['query']['users']:
+                counts[user['name']] = user.get('editcount', 0)
+        self.store(counts)
+        return counts
+
+    def get_many(self, names):
+        counts, missing = self.cached(set(names))
+        if missing:
+            counts.update(self.fetch(sorted(missing)))
+        return counts
+
+    def trusted(self, name):
+        return self.get_many([name]).get(name, 0) > TRUSTED_EDIT_COUNT
@@ -15,29 +15,27 @@
 # along with self program.  If not, see <http://www.gnu.org/licenses/>
 #
 
-from __future__ import absolute_import
+# A dict that keeps only the `size` most recently used items. Without any
+# dependencies, for the watcher as well as the detection code.
 
-import traceback
+import collections
 
-import wave
 
-from detection.utils import FileProxy
+class LRUCache(object):
+    def __init__(self, size):
+        self.size = size
+        self.__items = collections.OrderedDict()
 
-FRAMES_READ = 256
+    def __getitem__(self, key):
+        value = self.__items.pop(key)
+        self.__items[key] = value
+        return value
 
+    def __setitem__(self, key, value):
+        self.__items.pop(key, None)
+        self.__items[key] = value
+        if len(self.__items) > self.size:
+            self.__items.popitem(last=False)
 
-def detect(f):
-    with FileProxy(open(f, 'rb')) as f:
-        try:
-            wav = wave.open(f)
-
-            numframes = wav.getnframes()
-
-            for i in range(0, numframes, FRAMES_READ):
-                n = min(FRAMES_READ, numframes-i)
-                wav.readframes(n)
-        except Exception:
-            traceback.print_exc()
-            return
-
-        return f._maxseek, True
+    def clear(self):
+        self.__items.clear()
@@ -24,6 +24,7 @@ import pywikibot
 from pywikibot.comms.eventstreams import site_rc_listener
 
 from config import REDIS_KEY
+import editcounts
 
 TIMEOUT = 60  # We expect at least one rc entry every minute
 
@@ -39,6 +40,7 @@ def on_timeout(signum, frame):
 def run_watcher():
     site = pywikibot.Site(user="Embedded Data Bot")
     redis = Redis(host="tools-redis")
+    edit_counts = editcounts.EditCounts(site, redis)
 
     signal.signal(signal.SIGALRM, on_timeout)
     signal.alarm(TIMEOUT)
@@ -52,13 +54,26 @@ def run_watcher():
             change['namespace'] == 6 and
             change['log_type'] == 'upload'
         ):
+            try:
+                if edit_counts.trusted(change['user']):
+                    continue
+            except TimeoutError:
+                raise
+            except Exception as e:
+                # Queued anyway, the worker checks again
+                pywikibot.exception(e)
             redis.rpush(REDIS_KEY, json.dumps(change))
 
     pywikibot.output("Exit - THIS SHOULD NOT HAPPEN")
 
 
 def main():
-    pywikibot.handleArgs()
+    for arg in pywikibot.handleArgs():
+        # Seconds
+        if arg.startswith('-editcountttl:'):
+            editcounts.EDIT_COUNT_TTL = int(arg[len('-editcountttl:'):])
+        elif arg.startswith('-trustedttl:'):
+            editcounts.TRUSTED_TTL = int(arg[len('-trustedttl:'):])
     run_watcher()
 
 
@@ -16,27 +16,55 @@
 #
 
 import datetime
+import hashlib
 import json
+import multiprocessing
 import os
+import Queue
 import shutil
+import signal
+import sys
 import tempfile
 import threading
 import traceback
 import uuid
 
 import pywikibot
+from pywikibot.comms import http
 from pywikibot.data.api import APIError
+from pywikibot.page import FileInfo
 from pywikibot.throttle import Throttle
 from redis import Redis
 
 from config import REDIS_KEY
-from detection import detect
+from detection import VERSION as DETECTION_VERSION, detect, sandbox
+from detection.by_magic import scanner
+from detection.metrics import (
+    Exporter, Trace, activate, call_traced, count_read, span)
 from detection.by_ending import ARCHIVE_TYPES, UNKNOWN_TYPES
+import editcounts
 
 
 MESSAGE_PREFIX = ('This file contains [[COM:CSD#F9|'
                   'embedded data]]: ')
 
+# Pipeline mode, see run_pipeline()
+DOWNLOAD_THREADS = 2
+QUEUE_SIZE = 4
+
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+
+# Changes taken from Redis at once and looked up in one API query; 50 titles
+# is the most a query takes without the apihighlimits right
+BATCH_SIZE = 50
+IMAGEINFO_PROPS = 'timestamp|user|comment|url|size|sha1|mime|archivename'
+
+# Verdicts are cached by content SHA-1 and detection code version
+RESULT_CACHE_TTL = 30 * 24 * 3600
+
+# Paths are set by -metrics: and -trace:
+exporter = Exporter()
+
 
 def sizeof_fmt(num, suffix='B'):
     # Source: http://stackoverflow.com/a/1094933
@@ -47,122 +75,446 @@ def sizeof_fmt(num, suffix='B'):
     return "%.1f%s%s" % (num, 'Yi', suffix)
 
 
-def run_worker():
-    try:
-        tmpdir = tempfile.mkdtemp()
+def make_site():
+    site = pywikibot.Site(user="Embedded Data Bot")
+    site._throttle = Throttle(site, multiplydelay=False)
 
-        site = pywikibot.Site(user="Embedded Data Bot")
-        site._throttle = Throttle(site, multiplydelay=False)
+    # Multi-workers are enough to cause problems, no need for internal
+    # locking to cause even more problems
+    site.lock_page = lambda *args, **kwargs: None  # noop
+    site.unlock_page = lambda *args, **kwargs: None  # noop
 
-        # Multi-workers are enough to cause problems, no need for internal
-        # locking to cause even more problems
-        site.lock_page = lambda *args, **kwargs: None  # noop
-        site.unlock_page = lambda *args, **kwargs: None  # noop
+    return site
 
-        redis = Redis(host="tools-redis")
 
-        while True:
-            _, change = redis.blpop(REDIS_KEY)
-            change = json.loads(change)
-            filepage = pywikibot.FilePage(site, change['title'])
+def pop_changes(redis):
+    # Waits for one change, then takes those queued after it, up to
+    # BATCH_SIZE. In one transaction, other workers pop from the same list.
+    _, change = redis.blpop(REDIS_KEY)
+    pipe = redis.pipeline()
+    pipe.lrange(REDIS_KEY, 0, BATCH_SIZE - 2)
+    pipe.ltrim(REDIS_KEY, BATCH_SIZE - 1, -1)
+    changes, _ = pipe.execute()
+    return [json.loads(item) for item in [change] + changes]
 
-            if not filepage.exists():
-                continue
 
-            for i in range(8):
-                try:
-                    filepage.get_file_history()
-                except pywikibot.exceptions.PageRelatedError as e:
-                    # pywikibot.exceptions.PageRelatedError:
-                    # loadimageinfo: Query on ... returned no imageinfo
-                    pywikibot.exception(e)
-                    site.throttle(write=True)
-                else:
-                    break
+def requeue(redis, changes):
+    # Changes popped but not handled go back to the front of the list, for
+    # this or another worker
+    if changes:
+        redis.lpush(REDIS_KEY, *[json.dumps(change)
+                                 for change in reversed(changes)])
+
+
+def upload_timestamps(change):
+    # Of the uploaded revision: from the upload log, from rcbacklog, or the
+    # time of the change
+    if 'img_timestamp' in change.get('log_params', {}):
+        yield pywikibot.Timestamp.fromtimestampformat(
+            change['log_params']['img_timestamp'])
+    if 'img_timestamp' in change.get('params', {}):
+        yield pywikibot.Timestamp.fromISOformat(
+            change['params']['img_timestamp'])
+    if 'timestamp' in change:
+        yield pywikibot.Timestamp.fromtimestamp(change['timestamp'])
+
+
+def get_revisions(site, edit_counts, changes):
+    # get_revision() of each change, from one query for the pages, their
+    # latest revisions and the edit counts of the uploaders not cached. None
+    # where that is not enough: the upload is not the latest revision, or
+    # imageinfo is not there yet.
+    try:
+        counts, users = edit_counts.cached(
+            set(change['user'] for change in changes))
+        params = {}
+        if users:
+            params = dict(list='users', usprop='editcount',
+                          ususers=sorted(users))
+        res = site._simple_request(
+            action='query',
+            prop='imageinfo',
+            iiprop=IMAGEINFO_PROPS,
+            titles=sorted(set(change['title'] for change in changes)),
+            **params
+        ).submit()
+
+        query = res['query']
+        fetched = dict((user['name'], user.get('editcount', 0))
+                       for user in query.get('users', []))
+        edit_counts.store(fetched)
+        counts.update(fetched)
+    except Exception as e:
+        pywikibot.exception(e)
+        return [None] * len(changes)
+
+    normalized = dict((item['from'], item['to'])
+                      for item in query.get('normalized', []))
+    pages = dict((page['title'], page) for page in query['pages'].values())
+
+    ret = []
+    for change in changes:
+        page = pages.get(normalized.get(change['title'], change['title']))
+        if page is None or 'invalid' in page:
+            ret.append(None)
+        elif 'missing' in page:
+            ret.append((None, None))
+        elif not page.get('imageinfo') or 'user' not in page['imageinfo'][0]:
+            ret.append(None)
+        else:
+            revision = FileInfo(page['imageinfo'][0])
+            if revision.timestamp not in upload_timestamps(change) or \
+                    revision.user not in counts:
+                ret.append(None)
+            elif counts[revision.user] > editcounts.TRUSTED_EDIT_COUNT:
+                ret.append((None, None))
             else:
-                raise
+                ret.append((pywikibot.FilePage(site, page['title']),
+                            revision))
+    return ret
 
-            try:
-                revision = filepage.get_file_history()[
-                    pywikibot.Timestamp.fromtimestampformat(
-                        change['log_params']['img_timestamp'])]
-            except KeyError:
-                try:
-                    # From rcbacklog
-                    revision = filepage.get_file_history()[
-                        pywikibot.Timestamp.fromISOformat(
-                            change['params']['img_timestamp'])]
-                except KeyError:
-                    try:
-                        revision = filepage.get_file_history()[
-                            pywikibot.Timestamp.fromtimestamp(
-                                change['timestamp'])]
-                    except KeyError:
-                        revision = filepage.latest_file_info
-                        pywikibot.warning(
-                            'Cannot fetch specified revision, falling back to '
-                            'latest revision.')
 
-            if pywikibot.User(site, revision.user).editCount(
-                    force=True) > 200:
-                continue
+def get_revision(site, edit_counts, change):
+    filepage = pywikibot.FilePage(site, change['title'])
 
-            pywikibot.output('Working on: %s at %s' % (change['title'],
-                                                       revision.timestamp))
+    if not filepage.exists():
+        return None, None
 
-            path = os.path.join(tmpdir, str(uuid.uuid1()))
+    for i in range(8):
+        try:
+            filepage.get_file_history()
+        except pywikibot.exceptions.PageRelatedError as e:
+            # pywikibot.exceptions.PageRelatedError:
+            # loadimageinfo: Query on ... returned no imageinfo
+            pywikibot.exception(e)
+            site.throttle(write=True)
+        else:
+            break
+    else:
+        raise
 
-            # Download
-            try:
-                for i in range(8):
+    history = filepage.get_file_history()
+    for timestamp in upload_timestamps(change):
+        if timestamp in history:
+            revision = history[timestamp]
+            break
+    else:
+        revision = filepage.latest_file_info
+        pywikibot.warning(
+            'Cannot fetch specified revision, falling back to '
+            'latest revision.')
+
+    if edit_counts.trusted(revision.user):
+        return None, None
+
+    return filepage, revision
+
+
+def stream_download(revision, path):
+    # Like FilePage.download, but the magic scan and the SHA-1 are computed
+    # on the chunks as they arrive instead of rereading the file afterwards.
+    req = http.fetch(revision.url, stream=True)
+    if req.status != 200:
+        pywikibot.warning('Unsuccessful request (%s): %s'
+                          % (req.status, revision.url))
+        return
+
+    magic = scanner()
+    sha1 = hashlib.sha1()
+    with open(path, 'wb') as f:
+        for chunk in req.data.iter_content(DOWNLOAD_CHUNK_SIZE):
+            f.write(chunk)
+            count_read(len(chunk))
+            magic.feed(chunk)
+            sha1.update(chunk)
+
+    if sha1.hexdigest() == revision.sha1:
+        return magic.close()
+
+
+def download(filepage, revision, path):
+    for i in range(8):
+        try:
+            hits = stream_download(revision, path)
+        except Exception as e:
+            pywikibot.exception(e)
+            hits = None
+        if hits is not None:
+            return hits
+        else:
+            pywikibot.warning(
+                'Possibly corrupted download on attempt %d' % i)
+            filepage.site.throttle(write=True)
+    else:
+        pywikibot.warning('FIXME: Download attempt exhausted')
+
+
+def result_key(revision):
+    return '%s:result:%s:%s' % (REDIS_KEY, DETECTION_VERSION, revision.sha1)
+
+
+def load_result(redis, revision):
+    res = redis.get(result_key(revision))
+    if res is None:
+        return
+
+    res = json.loads(res)
+    for item in res:
+        item['mime'] = tuple(item['mime'])
+    return res
+
+
+def store_result(redis, revision, res):
+    redis.set(result_key(revision), json.dumps(res or []),
+              ex=RESULT_CACHE_TTL)
+
+
+def handle_result(filepage, revision, res, path):
+    if not res:
+        return
+
+    msg = []
+    for item in res:
+        if item['middleware']:
+            pos = item['middleware']
+        else:
+            pos = '%s (%s bytes, via %s)' % (
+                sizeof_fmt(item['pos']),
+                item['pos'],
+                ','.join(item['via']))
+            if not item['posexact']:
+                pos = 'about ' + pos
+
+        if item['mime'][0] in UNKNOWN_TYPES:
+            mime = 'Unidentified type (%s, %s)' % item['mime']
+        else:
+            mime = 'Identified type: %s (%s)' % item['mime']
+        msg.append('After %s: %s' % (pos, mime))
+    msg = '; '.join(msg)
+
+    pywikibot.output(u"\n\n>>> %s <<<"
+                     % filepage.title(asLink=True))
+    pywikibot.output(msg)
+
+    with span('action'):
+        execute_file(filepage, revision, msg, res, path)
+
+
+def record_trace(trace, filepage, revision):
+    try:
+        exporter.record(trace, title=filepage.title(), sha1=revision.sha1,
+                        timestamp=str(revision.timestamp))
+    except Exception:
+        traceback.print_exc()
+
+
+def remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def run_worker():
+    # Before the threads of pywikibot and the actions, see detection.sandbox
+    helper = sandbox.Helper()
+    # Changes of the batch not yet handled
+    changes = []
+    try:
+        tmpdir = tempfile.mkdtemp()
+
+        site = make_site()
+        redis = Redis(host="tools-redis")
+        edit_counts = editcounts.EditCounts(site, redis)
+
+        while True:
+            changes = pop_changes(redis)
+            # The trace of the first file has the span of the lookup
+            traces = [Trace() for i in changes]
+            with activate(traces[0]):
+                with span('wiki', 'batch'):
+                    revisions = get_revisions(site, edit_counts, changes)
+
+            for found, trace in zip(revisions, traces):
+                # Off the batch before it is handled, so that nothing is
+                # acted on twice
+                change = changes.pop(0)
+                path = None
+                with activate(trace):
                     try:
-                        success = filepage.download(path, revision=revision)
-                    except Exception as e:
-                        pywikibot.exception(e)
-                        success = False
-                    if success:
-                        break
+                        if found is None:
+                            with span('wiki', 'revision'):
+                                found = get_revision(
+                                    site, edit_counts, change)
+                        filepage, revision = found
+                        if not filepage:
+                            continue
+
+                        res = load_result(redis, revision)
+                        if res == []:
+                            continue
+
+                        pywikibot.output('Working on: %s at %s' % (
+                            change['title'], revision.timestamp))
+
+                        path = os.path.join(tmpdir, str(uuid.uuid1()))
+                        with span('download'):
+                            hits = download(filepage, revision, path)
+                        # A cached verdict is for the verified file, not
+                        # for whatever a failed download left behind
+                        if res is None or hits is None:
+                            res, spans = helper.call(
+                                call_traced, detect, path, hits)
+                            trace.spans += spans
+                            # Only cache what all detectors found in a
+                            # verified download
+                            if hits is not None and not res.incomplete:
+                                store_result(redis, revision, res)
+                        handle_result(filepage, revision, res, path)
+                    except sandbox.HelperDied:
+                        # No other can be forked safely, start over
+                        raise
+                    except Exception:
+                        traceback.print_exc()
+                    finally:
+                        if path:
+                            remove(path)
+
+                if path:
+                    record_trace(trace, filepage, revision)
+
+        pywikibot.output("Exit - THIS SHOULD NOT HAPPEN")
+    finally:
+        if changes:
+            requeue(redis, changes)
+        shutil.rmtree(tmpdir)
+
+
+def run_pipeline(processes, downloaders=DOWNLOAD_THREADS):
+    # Download -> detection -> action, each stage decoupled from the next by
+    # a bounded queue so that one slow file only ever occupies its own slot.
+    #
+    # Detection runs in a helper per detection thread, forked before any
+    # thread is started, see detection.sandbox
+    helpers = [sandbox.Helper() for i in range(processes)]
+    # Changes popped that no downloader took yet
+    waiting = []
+    waiting_lock = threading.Lock()
+    try:
+        tmpdir = tempfile.mkdtemp()
+
+        site = make_site()
+        redis = Redis(host="tools-redis")
+        edit_counts = editcounts.EditCounts(site, redis)
+
+        # Holds one batch; the next is only popped once the downloaders
+        # took all of it, the rest stays in Redis for other workers
+        looked_up = Queue.Queue(BATCH_SIZE)
+        downloaded = Queue.Queue(QUEUE_SIZE)
+        detected = Queue.Queue(QUEUE_SIZE)
+
+        def lookup_stage():
+            while True:
+                changes = pop_changes(redis)
+                with waiting_lock:
+                    waiting.extend(changes)
+                # The trace of the first file has the span of the lookup
+                traces = [Trace() for i in changes]
+                with activate(traces[0]):
+                    with span('wiki', 'batch'):
+                        revisions = get_revisions(site, edit_counts, changes)
+                for item in zip(changes, revisions, traces):
+                    looked_up.put(item)
+                looked_up.join()
+
+        def download_stage():
+            while True:
+                change, found, trace = looked_up.get()
+                with waiting_lock:
+                    waiting.remove(change)
+                looked_up.task_done()
+                path = None
+                try:
+                    with activate(trace):
+                        if found is None:
+                            with span('wiki', 'revision'):
+                                found = get_revision(site, edit_counts, change)
+                        filepage, revision = found
+                        if not filepage:
+                            continue
+
+                        res = load_result(redis, revision)
+                        if res == []:
+                            continue
+
+                        pywikibot.output('Working on: %s at %s' % (
+                            change['title'], revision.timestamp))
+
+                        path = os.path.join(tmpdir, str(uuid.uuid1()))
+                        with span('download'):
+                            hits = download(filepage, revision, path)
+                except Exception:
+                    traceback.print_exc()
+                    if path:
+                        remove(path)
+                else:
+                    if res is None or hits is None:
+                        downloaded.put(
+                            (filepage, revision, path, hits, trace))
                     else:
-                        pywikibot.warning(
-                            'Possibly corrupted download on attempt %d' % i)
-                        site.throttle(write=True)
+                        detected.put((filepage, revision, res, path, trace))
+
+        def detect_stage(helper):
+            while True:
+                filepage, revision, path, hits, trace = downloaded.get()
+                try:
+                    res, spans = helper.call(call_traced, detect, path, hits)
+                    trace.spans += spans
+                    if hits is not None and not res.incomplete:
+                        store_result(redis, revision, res)
+                except sandbox.HelperDied:
+                    # Ends the pipeline, no other can be forked safely
+                    remove(path)
+                    raise
+                except Exception:
+                    traceback.print_exc()
+                    remove(path)
                 else:
-                    pywikibot.warning('FIXME: Download attempt exhausted')
-
-                res = detect(path)
-                if res:
-                    msg = []
-                    for item in res:
-                        if item['middleware']:
-                            pos = item['middleware']
-                        else:
-                            pos = '%s (%s bytes, via %s)' % (
-                                sizeof_fmt(item['pos']),
-                                item['pos'],
-                                ','.join(item['via']))
-                            if not item['posexact']:
-                                pos = 'about ' + pos
-
-                        if item['mime'][0] in UNKNOWN_TYPES:
-                            mime = 'Unidentified type (%s, %s)' % item['mime']
-                        else:
-                            mime = 'Identified type: %s (%s)' % item['mime']
-                        msg.append('After %s: %s' % (pos, mime))
-                    msg = '; '.join(msg)
-
-                    pywikibot.output(u"\n\n>>> %s <<<"
-                                     % filepage.title(asLink=True))
-                    pywikibot.output(msg)
-
-                    execute_file(filepage, revision, msg, res, path)
+                    detected.put((filepage, revision, res, path, trace))
 
-            except Exception:
-                traceback.print_exc()
-            finally:
-                os.remove(path)
+        def action_stage():
+            while True:
+                filepage, revision, res, path, trace = detected.get()
+                try:
+                    with activate(trace):
+                        handle_result(filepage, revision, res, path)
+                except Exception:
+                    traceback.print_exc()
+                finally:
+                    remove(path)
+                record_trace(trace, filepage, revision)
+
+        threads = [threading.Thread(target=lookup_stage)]
+        threads += [threading.Thread(target=download_stage)
+                    for i in range(downloaders)]
+        threads += [threading.Thread(target=detect_stage, args=(helper,))
+                    for helper in helpers]
+        threads.append(threading.Thread(target=action_stage))
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        while all(thread.is_alive() for thread in threads):
+            # Thread.join() without timeout cannot be interrupted
+            threads[0].join(60)
 
         pywikibot.output("Exit - THIS SHOULD NOT HAPPEN")
     finally:
+        with waiting_lock:
+            if waiting:
+                requeue(redis, waiting)
+        for helper in helpers:
+            helper.process.terminate()
         shutil.rmtree(tmpdir)
 
 
@@ -375,8 +727,40 @@ def add_speedy(filepage, msg):
 
 
 def main():
-    pywikibot.handleArgs()
-    run_worker()
+    processes = None
+    downloaders = DOWNLOAD_THREADS
+    for arg in pywikibot.handleArgs():
+        if arg.startswith('-processes:'):
+            processes = int(arg[len('-processes:'):]) or \
+                multiprocessing.cpu_count()
+        elif arg.startswith('-downloaders:'):
+            downloaders = int(arg[len('-downloaders:'):])
+        elif arg.startswith('-metrics:'):
+            exporter.prom_path = arg[len('-metrics:'):]
+        elif arg.startswith('-trace:'):
+            exporter.trace_path = arg[len('-trace:'):]
+        # Limits per detector, 0 for none
+        elif arg.startswith('-timeout:'):
+            sandbox.WALL_TIME = float(arg[len('-timeout:'):]) or None
+        elif arg.startswith('-cputime:'):
+            sandbox.CPU_TIME = int(arg[len('-cputime:'):]) or None
+        elif arg.startswith('-maxrss:'):
+            # MiB
+            sandbox.MAX_RSS = int(arg[len('-maxrss:'):]) << 20 or None
+        # Seconds
+        elif arg.startswith('-editcountttl:'):
+            editcounts.EDIT_COUNT_TTL = int(arg[len('-editcountttl:'):])
+        elif arg.startswith('-trustedttl:'):
+            editcounts.TRUSTED_TTL = int(arg[len('-trustedttl:'):])
+
+    # Stopping the job sends SIGTERM; exit through the finally clauses, which
+    # push the changes not handled back to Redis
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
+
+    if processes:
+        run_pipeline(processes, downloaders)
+    else:
+        run_worker()
 
 
 if __name__ == "__main__":